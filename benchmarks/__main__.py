@@ -0,0 +1,159 @@
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+from benchmarks import windsx_data
+from card_auto_add.windsx.activations import WinDSXCardActivations, CardInfo
+from card_auto_add.windsx.card_holders import WinDSXActiveCardHolders
+from card_auto_add.windsx.card_scan import WinDSXCardScan
+from card_auto_add.windsx.database import Database
+from card_auto_add.windsx.query_stats import QueryStats
+from card_auto_add.windsx.reference_data import ReferenceDataCache
+from card_auto_add.windsx.sqlite_backend import SqliteBackend
+
+# Times the WinDSX operations we care about against a SQLite stand-in of the WinDSX databases, at a few sizes:
+#
+#     python -m benchmarks
+#     python -m benchmarks --sizes 1000 10000 --repeat 50
+#     python -m benchmarks --sizes 10000 --query-stats
+#
+# Generated databases are kept in the work directory and reused, every benchmark runs against a fresh copy of them.
+
+
+class BenchmarkConfig(object):
+    def __init__(self):
+        self.logger = logging.getLogger("benchmarks")
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+        self.slack_logger = self.logger
+        self.windsx_acl = windsx_data.DEFAULT_ACL
+        self.download_mode = "incremental"
+
+
+def _card_info(name_index: int) -> CardInfo:
+    return CardInfo(
+        first_name=f"First{name_index}",
+        last_name=f"Last{name_index}",
+        company=windsx_data.COMPANY_NAME,
+        woo_id=windsx_data.user_id_for(name_index),
+        card=str(windsx_data.card_code_for(name_index))
+    )
+
+
+def _report(name: str, size: int, timings: List[float]):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<28} {size:>8} {len(timings):>6} {statistics.mean(timings) * 1000:>10.2f} "
+          f"{statistics.median(timings) * 1000:>10.2f} {p95 * 1000:>10.2f}")
+
+
+def _time(func: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def _fixture(work_dir, size: int):
+    acs_path = os.path.join(work_dir, f"acs_{size}.sqlite")
+    log_path = os.path.join(work_dir, f"log_{size}.sqlite")
+
+    if not os.path.exists(acs_path) or not os.path.exists(log_path):
+        print(f"Generating {size} cards...")
+        for path in (acs_path, log_path):
+            if os.path.exists(path):
+                os.remove(path)
+        windsx_data.create_acs_database(acs_path, size)
+        windsx_data.create_log_database(log_path, size, scans=size)
+
+    return acs_path, log_path
+
+
+def _fresh_copy(path, run_dir) -> Database:
+    copy = os.path.join(run_dir, os.path.basename(path))
+    shutil.copyfile(path, copy)
+    return Database(SqliteBackend(copy), QueryStats(os.path.basename(path)))
+
+
+def benchmark_activations(acs_path, run_dir, size: int, repeat: int, query_stats: bool):
+    acs_db = _fresh_copy(acs_path, run_dir)
+    config = BenchmarkConfig()
+    # Downloads are never requested, every change is committed with update_system=False
+    activations = WinDSXCardActivations(config, acs_db, None, ReferenceDataCache(acs_db))
+
+    def activate(card_info):
+        with activations.transaction():
+            activations.activate(card_info, update_system=False)
+
+    def deactivate(card_info):
+        with activations.transaction():
+            activations.deactivate(card_info, update_system=False)
+
+    existing = [_card_info(i) for i in range(min(repeat, size))]
+    new = [_card_info(size + i) for i in range(repeat)]
+
+    _report("activate (existing card)", size, [_time(lambda: activate(card_info)) for card_info in existing])
+    _report("activate (new card)", size, [_time(lambda: activate(card_info)) for card_info in new])
+    _report("activate (already active)", size, [_time(lambda: activate(card_info)) for card_info in existing])
+    _report("deactivate", size, [_time(lambda: deactivate(card_info)) for card_info in existing])
+
+    if query_stats:
+        print(acs_db.stats.dump())
+
+    acs_db.close()
+
+
+def benchmark_reads(acs_path, log_path, run_dir, size: int, repeat: int, query_stats: bool):
+    acs_db = _fresh_copy(acs_path, run_dir)
+    log_db = _fresh_copy(log_path, run_dir)
+    card_holders = WinDSXActiveCardHolders(acs_db)
+    card_scan = WinDSXCardScan(acs_db, log_db, ReferenceDataCache(acs_db))
+    since = datetime.now() - timedelta(days=2)
+    runs = max(1, repeat // 10)
+
+    def read_card_holders():
+        for _ in card_holders.get_active_card_holders(windsx_data.COMPANY_NAME):
+            pass
+
+    def read_scans():
+        for _ in card_scan.get_scan_events_since(since):
+            pass
+
+    _report("get_active_card_holders", size, [_time(read_card_holders) for _ in range(runs)])
+    _report("get_scan_events_since", size, [_time(read_scans) for _ in range(runs)])
+
+    if query_stats:
+        print(acs_db.stats.dump())
+        print(log_db.stats.dump())
+
+    acs_db.close()
+    log_db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark WinDSX operations against a SQLite stand-in")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Cards to generate")
+    parser.add_argument("--repeat", type=int, default=100, help="Cards to activate/deactivate per size")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "card_auto_add_benchmarks"),
+                        help="Where generated databases are kept between runs")
+    parser.add_argument("--query-stats", action="store_true", help="Print per statement timings after each benchmark")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    print(f"{'benchmark':<28} {'cards':>8} {'runs':>6} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for size in args.sizes:
+        acs_path, log_path = _fixture(args.work_dir, size)
+
+        with tempfile.TemporaryDirectory() as run_dir:
+            benchmark_activations(acs_path, run_dir, size, args.repeat, args.query_stats)
+            benchmark_reads(acs_path, log_path, run_dir, size, args.repeat, args.query_stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import random
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+
+from card_auto_add.windsx.sqlite_backend import SqliteBackend
+
+# Synthetic WinDSX data that's shaped like ours: one location, a couple dozen doors, a handful of ACL groups, most names
+# in the denhac company with one card each, and a day of scans in the event log.
+
+COMPANY_NAME = "denhac"
+DEFAULT_ACL = "Members"
+UDF_NAME = "ID"
+
+LOC = 3
+DEVICES = 24
+ACL_GROUP_NAMES = ["Members", "Officers", "Classroom", "Shop", "Board"]
+
+EVENT_ACCESS_ALLOWED = 8
+EVENT_ACCESS_DENIED_UNKNOWN = 174
+
+FIRST_CARD_CODE = 100000
+
+
+def user_id_for(name_index: int) -> int:
+    return 1000 + name_index
+
+
+def card_code_for(name_index: int) -> int:
+    return FIRST_CARD_CODE + name_index
+
+
+def create_acs_database(path, cards: int, seed: int = 0) -> SqliteBackend:
+    rng = random.Random(seed)
+    backend = SqliteBackend.create(path)
+
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.executemany("INSERT INTO COMPANY(Company, Name) VALUES (?, ?)", [(1, COMPANY_NAME), (2, "guests")])
+        connection.execute("INSERT INTO UdfName(UdfNum, Name) VALUES (1, ?)", (UDF_NAME,))
+        connection.execute(
+            "INSERT INTO LOC(Loc, PlFlag, DlFlag, FullDlFlag, NodeCs, CodeCs, AclCs, DGrpCs) "
+            "VALUES (?, 0, 0, 0, 0, 0, 0, 0)",
+            (LOC,)
+        )
+        connection.executemany("INSERT INTO DEV(Device, Name, DlFlag, CkSum) VALUES (?, ?, 0, 0)",
+                               [(device, f"Door {device}") for device in range(DEVICES)])
+        connection.executemany("INSERT INTO IO(IO, DlFlag) VALUES (?, 0)", [(io,) for io in range(1, 5)])
+
+        # Each ACL group opens a slice of the doors in time zone 1, and Members also get a few in time zone 2
+        device_groups = {}
+        for name_id, name in enumerate(ACL_GROUP_NAMES, start=1):
+            connection.execute("INSERT INTO AclGrpName(ID, Name) VALUES (?, ?)", (name_id, name))
+            devices = rng.sample(range(DEVICES), 4 + name_id)
+            for device in devices:
+                connection.execute(
+                    "INSERT INTO ACLGrp(AclGrpNameID, Dev, Tz1, Tz2, Tz3, Tz4) VALUES (?, ?, 1, ?, 0, 0)",
+                    (name_id, device, 2 if name_id == 1 and device < 4 else 0)
+                )
+            # One single group combo per ACL group
+            connection.execute("INSERT INTO AclGrpCombo(AclGrpNameID, ComboID, LocGrp) VALUES (?, ?, ?)",
+                               (name_id, name_id, LOC))
+            device_groups[name_id] = devices
+
+        for device_group, devices in device_groups.items():
+            values = [device_group, 0, 0] + [device in devices for device in range(128)]
+            columns = ["DGrp", "DlFlag", "CkSum"] + [f"D{i}" for i in range(128)]
+            connection.execute(
+                f"INSERT INTO DGRP({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                values
+            )
+            connection.execute("INSERT INTO ACL(Loc, Acl, Tz, DGrp, DlFlag, CkSum) VALUES (?, ?, 1, ?, 0, 0)",
+                               (LOC, device_group, device_group))
+
+        now = datetime.now().replace(microsecond=0)
+        never = datetime(9999, 12, 31)
+        for name_index in range(cards):
+            company = 1 if rng.random() < 0.9 else 2
+            cursor = connection.execute(
+                "INSERT INTO NAMES(LocGrp, FName, LName, Company) VALUES (?, ?, ?, ?)",
+                (LOC, f"First{name_index}", f"Last{name_index}", company)
+            )
+            name_id = cursor.lastrowid
+
+            customer_uuid = str(uuid.uuid5(uuid.NAMESPACE_OID, str(user_id_for(name_index))))
+            connection.execute("INSERT INTO UDF(LocGrp, NameID, UdfNum, UdfText) VALUES (?, ?, 1, ?)",
+                               (LOC, name_id, customer_uuid))
+
+            active = rng.random() < 0.7
+            combo_id = 1 if rng.random() < 0.95 else rng.randint(2, len(ACL_GROUP_NAMES))
+            code = card_code_for(name_index)
+            cursor = connection.execute(
+                """
+                    INSERT INTO CARDS(NameID, LocGrp, Code, StartDate, StopDate, Status, CardNum, DlFlag, AclGrpComboId)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)
+                """,
+                (name_id, LOC, code, now - timedelta(days=365), never if active else now - timedelta(days=30), active,
+                 str(code), combo_id)
+            )
+            connection.execute(
+                "INSERT INTO LocCards(Loc, CardID, DlFlag, CkSum, Acl, Acl1, Acl2, Acl3, Acl4) "
+                "VALUES (?, ?, 0, 0, ?, -1, -1, -1, -1)",
+                (LOC, cursor.lastrowid, combo_id)
+            )
+    connection.close()
+
+    return backend
+
+
+def create_log_database(path, cards: int, scans: int, seed: int = 0) -> SqliteBackend:
+    rng = random.Random(seed)
+    backend = SqliteBackend.create(path)
+
+    start = datetime.now().replace(microsecond=0) - timedelta(days=1)
+    rows = []
+    for i in range(scans):
+        name_index = rng.randrange(cards)
+        allowed = rng.random() < 0.95
+        rows.append((
+            start + timedelta(seconds=i * 86400 // max(scans, 1)),
+            EVENT_ACCESS_ALLOWED if allowed else EVENT_ACCESS_DENIED_UNKNOWN,
+            card_code_for(name_index),
+            name_index + 1,  # NAMES IDs are assigned in order starting at 1
+            rng.randrange(DEVICES),
+            1,  # The scan query filters IO on the denhac company ID
+        ))
+
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.executemany(
+            "INSERT INTO EvnLog(TimeDate, Event, Code, Opr, Dev, IO) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    connection.close()
+
+    return backend
@@ -1,8 +1,5 @@
-import atexit
 import logging
 import signal
-import sys
-import time
 from logging.handlers import RotatingFileHandler
 
 import sentry_sdk
@@ -13,11 +10,22 @@ from card_auto_add.loops.active_cards_watcher import ActiveCardsWatcher
 from card_auto_add.loops.card_scan_watcher import CardScanWatcher
 from card_auto_add.loops.comm_server_watcher import CommServerWatcher
 from card_auto_add.loops.door_override_watcher import DoorOverrideWatcher
+from card_auto_add.loops.download_tracker import DownloadTracker
 from card_auto_add.loops.ingester import Ingester
+from card_auto_add.loops.scan_uploader import ScanUploader
+from card_auto_add.loops.status_reporter import StatusReporter
+from card_auto_add.retry_queue import RetryQueue
+from card_auto_add.runtime import Runtime
+from card_auto_add.scan_spool import ScanSpool
+from card_auto_add.update_journal import UpdateJournal
+from card_auto_add.windsx.access_backend import AccessBackend
 from card_auto_add.windsx.activations import WinDSXCardActivations
 from card_auto_add.windsx.card_holders import WinDSXActiveCardHolders
 from card_auto_add.windsx.card_scan import WinDSXCardScan
 from card_auto_add.windsx.database import Database
+from card_auto_add.windsx.query_stats import QueryStats
+from card_auto_add.windsx.reference_data import ReferenceDataCache
+from card_auto_add.windsx.snapshot import SnapshotReader
 
 logger = logging.getLogger("card_access")
 logger.setLevel(logging.INFO)
@@ -41,40 +49,84 @@ config = Config(logger)
 sentry_sdk.init(config.sentry_dsn)
 
 server_api = WebhookServerApi(config)
+runtime = Runtime(config)
 
 comm_server_watcher = CommServerWatcher(config)
-comm_server_watcher.start()
+comm_server_watcher.start(runtime)
 
-acs_db = Database(config.acs_data_db_path)
-log_db = Database(config.log_db_path)
+acs_db = Database(AccessBackend(config.acs_data_db_path),
+                  QueryStats("acs_data", config.logger, config.slow_query_seconds))
+log_db = Database(AccessBackend(config.log_db_path),
+                  QueryStats("log", config.logger, config.slow_query_seconds))
+reference_data = ReferenceDataCache(acs_db)
 
-card_activations = WinDSXCardActivations(config, acs_db, comm_server_watcher)
-ingester = Ingester(config, card_activations, server_api)
-ingester.start()
+acs_snapshot = None
+if config.snapshot_reads:
+    acs_snapshot = SnapshotReader(config.acs_data_db_path, config.snapshot_dir, AccessBackend,
+                                  QueryStats("acs_data snapshot", config.logger, config.slow_query_seconds),
+                                  config.snapshot_min_refresh_seconds, config.logger)
+    acs_snapshot.start(runtime)
 
-card_holders = WinDSXActiveCardHolders(acs_db)
+download_tracker = DownloadTracker(config, acs_db, comm_server_watcher)
+download_tracker.start(runtime)
+
+card_activations = WinDSXCardActivations(config, acs_db, download_tracker, reference_data)
+status_reporter = StatusReporter(config, server_api)
+status_reporter.start(runtime)
+
+update_journal = UpdateJournal(config.journal_path)
+ingester = Ingester(config, card_activations, server_api, status_reporter, update_journal, RetryQueue())
+ingester.start(runtime)
+
+card_holders = WinDSXActiveCardHolders(acs_db if acs_snapshot is None else acs_snapshot)
 active_cards_watcher = ActiveCardsWatcher(config, server_api, card_holders)
-active_cards_watcher.start()
+active_cards_watcher.start(runtime)
 
-card_scan = WinDSXCardScan(acs_db, log_db)
-card_scan_watcher = CardScanWatcher(config, server_api, card_scan)
-card_scan_watcher.start()
+scan_spool = ScanSpool(config.scan_spool_path)
+scan_uploader = ScanUploader(config, server_api, scan_spool)
+scan_uploader.start(runtime)
+
+card_scan = WinDSXCardScan(acs_db, log_db, reference_data, acs_snapshot)
+card_scan_watcher = CardScanWatcher(config, card_scan, scan_spool, scan_uploader)
+card_scan_watcher.start(runtime)
 
 door_overrides = DoorOverrideWatcher(config)
-door_overrides.start()
+door_overrides.start(runtime)
+
+
+def log_query_stats():
+    for database in (acs_db, log_db, acs_snapshot):
+        if database is not None:
+            logger.info(database.stats.dump())
+
+
+query_stats_task = runtime.every("query_stats", log_query_stats, 60 * 60)  # 1 hour
+runtime.on_shutdown(log_query_stats)
 
 config.slack_logger.info("denhac card access automation started")
 
+# When the OS tries to terminate us, stop the runtime so every task gets to finish what it's doing and clean up
+signal.signal(signal.SIGTERM, lambda num, frame: runtime.stop())
+signal.signal(signal.SIGINT, lambda num, frame: runtime.stop())
+
+
+def on_operator_signal(num, frame):
+    query_stats_task.trigger()
+    active_cards_watcher.request_full_sync()
+
 
-# @atexit.register
-# def goodbye():  # TODO Shut down all the threads
-#     config.slack_logger.info("denhac card access automation is shutting down")
+# Ctrl+Break in our console on Windows (SIGUSR1 elsewhere) logs the query stats and uploads every active card holder
+# right away
+for operator_signal in ("SIGBREAK", "SIGUSR1"):
+    if hasattr(signal, operator_signal):
+        signal.signal(getattr(signal, operator_signal), on_operator_signal)
 
+# Runs until stopped
+runtime.run()
 
-# When the OS tries to terminate us, make sure we exit cleanly. This ensures goodbye is called as well.
-signal.signal(signal.SIGTERM, lambda num, frame: sys.exit(0))
+acs_db.close()
+log_db.close()
+if acs_snapshot is not None:
+    acs_snapshot.close()
 
-# Main thread runs forever. Theoretically could be avoided if our other threads were non-daemon and were cleaned up
-# in goodbye correctly.
-while True:
-    time.sleep(60)
+config.slack_logger.info("denhac card access automation is shutting down")
@@ -1,30 +1,75 @@
-import requests
+import gzip
+import json
+import shutil
+import tempfile
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
 from sentry_sdk import capture_exception
 
 from card_auto_add.config import Config
-from card_auto_add.windsx.card_scan import CardScan
+from card_auto_add.http_transport import HttpTransport
 
 
 class WebhookServerApi(object):
+    # Request bodies bigger than this are spooled to a temporary file instead of being kept in memory
+    _max_in_memory_body_bytes = 1024 * 1024
+
     def __init__(self, config: Config):
         self._api_url = config.ingester_api_url
 
-        self._session = requests.Session()
-        self._session.headers["Authorization"] = f"Bearer {config.ingester_api_key}"
-        self._session.headers["Accept"] = "application/json"
+        self._transport = HttpTransport()
+        self._transport.session.headers["Authorization"] = f"Bearer {config.ingester_api_key}"
+        self._transport.session.headers["Accept"] = "application/json"
+        self._transport.endpoint("card_updates", read_timeout=30)
+        self._transport.endpoint("status", read_timeout=15)
+        self._transport.endpoint("active_card_holders", read_timeout=120)
+        self._transport.endpoint("card_scan", read_timeout=15)
         self._logger = config.logger
+        self._gzip_supported = True  # Until the server turns down a compressed body
+
+        # Conditional polling state for /card_updates
+        self._etag = None
+        self._last_modified = None
+        self._last_seen_update_id = None
 
     def get_command_json(self):
         try:
-            response = self._session.get(f"{self._api_url}/card_updates")
+            # Only ask for what's changed since the last poll. A server that understands these answers 304 (no body,
+            # nothing to parse) or just the new updates. One that doesn't will ignore them and send the full list.
+            headers = {}
+            if self._etag is not None:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified is not None:
+                headers["If-Modified-Since"] = self._last_modified
+
+            params = {}
+            if self._last_seen_update_id is not None:
+                params["since"] = self._last_seen_update_id
+
+            response = self._transport.get("card_updates", f"{self._api_url}/card_updates",
+                                           headers=headers, params=params)
+
+            if response.status_code == 304:
+                return []
 
             if response.ok:
+                self._etag = response.headers.get("ETag")
+                self._last_modified = response.headers.get("Last-Modified")
+
+                if len(response.content) == 0:
+                    return []
+
                 json_response = response.json()
 
                 if "data" not in json_response:
                     return None
 
-                return json_response["data"]
+                updates = json_response["data"]
+                for update in updates:
+                    if self._last_seen_update_id is None or update["id"] > self._last_seen_update_id:
+                        self._last_seen_update_id = update["id"]
+
+                return updates
 
             else:
                 self._logger.info(f"read response from API server was {response.status_code} which is not ok!")
@@ -36,15 +81,15 @@ class WebhookServerApi(object):
             capture_exception(e)
             pass  # Yeah, we should probably do something about this
 
-    def submit_status(self, command_id, status):
+    def submit_status(self, command_id, status) -> bool:
         try:
             url = f"{self._api_url}/card_updates/{command_id}/status"
-            response = self._session.post(url, json={
+            response = self._transport.post("status", url, json={
                 "status": status
             })
 
             if response.ok:
-                return
+                return True
 
             else:
                 self._logger.info(f"status response from API server was {response.status_code} which is not ok!")
@@ -54,45 +99,168 @@ class WebhookServerApi(object):
         except Exception as e:
             self._logger.info(e)
             capture_exception(e)
-            pass  # Yeah, we should probably do something about this
+            return False
 
-    def submit_active_card_holders(self, active_card_holders):
+    # Submits several statuses in one request. Returns None if the server doesn't know about this endpoint, in which
+    # case statuses have to go through submit_status one at a time.
+    def submit_statuses(self, statuses: List[Tuple[Any, str]]) -> Optional[bool]:
+        try:
+            url = f"{self._api_url}/card_updates/statuses"
+            response = self._transport.post("status", url, json={
+                "statuses": [{"id": command_id, "status": status} for command_id, status in statuses]
+            })
+
+            if response.ok:
+                return True
+            elif response.status_code in (404, 405):
+                return None
+            else:
+                self._logger.info(f"statuses response from API server was {response.status_code} which is not ok!")
+                raise Exception(f"Submit statuses returned {response.status_code}")
+        except Exception as e:
+            self._logger.info(e)
+            capture_exception(e)
+            return False
+
+    # active_card_holders can be any iterable, including a generator, and is streamed into the request body
+    def submit_active_card_holders(self, active_card_holders: Iterable[dict]) -> bool:
         try:
             url = f"{self._api_url}/active_card_holders"
             self._logger.info("Posting active card holders")
-            response = self._session.post(url, json={
+            response = self._post_json("active_card_holders", url, {
                 "card_holders": active_card_holders
             })
 
             if response.ok:
-                return
+                return True
             else:
                 self._logger.info(f"status response from API server was {response.status_code} which is not ok!")
                 raise Exception(f"Submit status returned {response.status_code}")
         except Exception as e:
             self._logger.info(e)
             capture_exception(e)
-            pass  # Yeah, we should probably do something about this
+            return False
 
-    def submit_card_scan_event(self, card_scan: CardScan):
+    # Sends only what changed since the last successful upload. Returns None if the server doesn't know about this
+    # endpoint, in which case the full list has to go through submit_active_card_holders.
+    def submit_active_card_holder_changes(self, added, changed, removed) -> Optional[bool]:
+        try:
+            url = f"{self._api_url}/active_card_holders/changes"
+            self._logger.info(f"Posting active card holder changes: {len(added)} added, {len(changed)} changed, "
+                              f"{len(removed)} removed")
+            response = self._post_json("active_card_holders", url, {
+                "added": added,
+                "changed": changed,
+                "removed": removed,
+            })
+
+            if response.ok:
+                return True
+            elif response.status_code in (404, 405):
+                return None
+            else:
+                self._logger.info(f"changes response from API server was {response.status_code} which is not ok!")
+                raise Exception(f"Submit active card holder changes returned {response.status_code}")
+        except Exception as e:
+            self._logger.info(e)
+            capture_exception(e)
+            return False
+
+    def submit_card_scan_event(self, card_scan: dict) -> bool:
         try:
             url = f"{self._api_url}/events/card_scanned"
             self._logger.info(url)
-            response = self._session.post(url, json={
-                "first_name": card_scan.first_name,
-                "last_name": card_scan.last_name,
-                "card_num": card_scan.card,
-                "scan_time": card_scan.scan_time.isoformat(),
-                "access_allowed": card_scan.access_allowed,
-                "device": card_scan.device,
-            })
+            response = self._transport.post("card_scan", url, json=card_scan)
 
             if response.ok:
-                return
+                return True
             else:
                 self._logger.info(f"card scanned response from API server was {response.status_code} which is not ok!")
                 raise Exception(f"Submit status returned {response.status_code}")
         except Exception as e:
             self._logger.info(e)
             capture_exception(e)
-            pass  # Yeah, we should probably do something about this
+            return False
+
+    # Submits several card scans in one request. Returns None if the server doesn't know about this endpoint, in which
+    # case scans have to go through submit_card_scan_event one at a time.
+    def submit_card_scan_events(self, card_scans: List[dict]) -> Optional[bool]:
+        try:
+            url = f"{self._api_url}/events/card_scanned/batch"
+            self._logger.info(f"Posting {len(card_scans)} card scan(s)")
+            response = self._post_json("card_scan", url, {
+                "events": card_scans
+            })
+
+            if response.ok:
+                return True
+            elif response.status_code in (404, 405):
+                return None
+            else:
+                self._logger.info(f"card scans response from API server was {response.status_code} which is not ok!")
+                raise Exception(f"Submit card scans returned {response.status_code}")
+        except Exception as e:
+            self._logger.info(e)
+            capture_exception(e)
+            return False
+
+    # The body is encoded and compressed incrementally, so payloads containing generators are never materialized. The
+    # whole payload is consumed before the request is sent, so whatever produces it (like a database cursor) isn't held
+    # open for the duration of the upload.
+    #
+    # A server that doesn't decode gzipped request bodies answers 400 or 415. The body is then sent again uncompressed,
+    # and every request after that is sent uncompressed too.
+    def _post_json(self, endpoint, url, payload: dict):
+        compress = self._gzip_supported
+
+        with tempfile.SpooledTemporaryFile(max_size=self._max_in_memory_body_bytes) as body:
+            if compress:
+                with gzip.GzipFile(fileobj=body, mode="wb") as compressed:
+                    for chunk in self._json_chunks(payload):
+                        compressed.write(chunk.encode("utf-8"))
+            else:
+                for chunk in self._json_chunks(payload):
+                    body.write(chunk.encode("utf-8"))
+
+            response = self._post_body(endpoint, url, body, compress)
+            if not compress or response.status_code not in (400, 415):
+                return response
+
+            self._logger.info(f"Server answered {response.status_code} to a gzipped body, sending plain JSON instead")
+            self._gzip_supported = False
+
+            with tempfile.SpooledTemporaryFile(max_size=self._max_in_memory_body_bytes) as plain:
+                body.seek(0)
+                with gzip.GzipFile(fileobj=body, mode="rb") as decompressed:
+                    shutil.copyfileobj(decompressed, plain)
+
+                return self._post_body(endpoint, url, plain, False)
+
+    # Sends everything written to body so far
+    def _post_body(self, endpoint, url, body, compressed: bool):
+        size = body.tell()
+        body.seek(0)
+        data = body.read() if size <= self._max_in_memory_body_bytes else body
+
+        headers = {"Content-Type": "application/json"}
+        if compressed:
+            headers["Content-Encoding"] = "gzip"
+
+        return self._transport.post(endpoint, url, data=data, headers=headers)
+
+    # Encodes a payload dict as JSON a piece at a time. Top level values that are lists or iterators are written out one
+    # item at a time.
+    @staticmethod
+    def _json_chunks(payload: dict) -> Iterator[str]:
+        yield "{"
+        for index, (key, value) in enumerate(payload.items()):
+            yield ("," if index > 0 else "") + json.dumps(key) + ":"
+
+            if isinstance(value, (list, tuple, Iterator)):
+                yield "["
+                for item_index, item in enumerate(value):
+                    yield ("," if item_index > 0 else "") + json.dumps(item)
+                yield "]"
+            else:
+                yield json.dumps(value)
+        yield "}"
@@ -0,0 +1,15 @@
+import requests
+from pysherplus.authentication import URLAuthentication
+from pysherplus.pusher import PusherHost, Pusher
+
+from card_auto_add.config import Config
+
+
+# Builds an authenticated Pusher client for the webhook server's private channels. Each caller gets its own connection.
+def create_pusher(config: Config) -> Pusher:
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {config.ingester_api_key}"
+    auth = URLAuthentication("https://webhooks.denhac.org/broadcasting/auth", session)
+    pusher_host = PusherHost.from_url("https://ws.webhooks.denhac.org/app/denhac")
+
+    return Pusher(pusher_host, authenticator=auth)
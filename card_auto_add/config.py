@@ -12,16 +12,26 @@ T = TypeVar('T')
 
 
 class ConfigProperty(Generic[T]):
-    def __init__(self, section, key, transform: Optional[Callable[[str], T]] = None):
+    def __init__(self, section, key,
+                 transform: Optional[Callable[[str], T]] = None,
+                 default: Optional[str] = None):
         self._section = section
         self._key = key
         if transform is None:
             def transform(x):
                 return x
         self._transform = transform
+        self._default = default
 
     def __get__(self, instance, owner) -> T:
-        return self._transform(instance[self._section][self._key])
+        try:
+            value = instance[self._section][self._key]
+        except KeyError:
+            if self._default is None:
+                raise
+            value = self._default
+
+        return self._transform(value)
 
 
 class Config(object):
@@ -47,17 +57,41 @@ class Config(object):
     def __getitem__(self, item):
         return self._config[item]
 
+    def task_interval(self, name, default: float) -> float:
+        if self._config.has_option('INTERVALS', name):
+            return float(self._config['INTERVALS'][name])
+
+        return default
+
     acs_data_db_path = ConfigProperty('WINDSX', 'acs_data_db_path')
     log_db_path = ConfigProperty('WINDSX', 'log_db_path')
     windsx_path = ConfigProperty('WINDSX', 'root_path')
     windsx_username = ConfigProperty('WINDSX', 'username')
     windsx_password = ConfigProperty('WINDSX', 'password')
     windsx_acl = ConfigProperty('WINDSX', 'acl')
+    slow_query_seconds = ConfigProperty('WINDSX', 'slow_query_ms', transform=lambda x: float(x) / 1000, default="500")
+    # Reports and scan enrichment read from a local copy of acs_data, refreshed at most every min_refresh_seconds
+    snapshot_reads = ConfigProperty('WINDSX', 'snapshot_reads', transform=lambda x: x.lower() in ("true", "yes", "1"),
+                                    default="true")
+    snapshot_dir = ConfigProperty('WINDSX', 'snapshot_dir',
+                                  default=os.path.join(appdirs.user_config_dir(), ".card_auto_add_snapshots"))
+    snapshot_min_refresh_seconds = ConfigProperty('WINDSX', 'snapshot_min_refresh_seconds',
+                                                  transform=lambda x: float(x), default="60")
 
     ingest_path = ConfigProperty('INGEST', 'root_path')
     no_interaction_delay = ConfigProperty('INGEST', 'no_interaction_delay', transform=lambda x: int(x))
     ingester_api_key = ConfigProperty('INGEST', 'api_key')
     ingester_api_url = ConfigProperty('INGEST', 'api_url')
+    # "incremental" pushes just the changed rows to the hardware, "full" always makes the Comm Server send everything
+    download_mode = ConfigProperty('INGEST', 'download_mode', default="incremental")
+    journal_path = ConfigProperty('INGEST', 'journal_path',
+                                  default=os.path.join(appdirs.user_config_dir(), ".card_auto_add_journal.sqlite"))
+
+    scan_spool_path = ConfigProperty('WINDSX', 'scan_spool_path',
+                                     default=os.path.join(appdirs.user_config_dir(), ".card_auto_add_scans.sqlite"))
+
+    runtime_max_workers = ConfigProperty('RUNTIME', 'max_workers', transform=lambda x: int(x), default="8")
+    runtime_jitter = ConfigProperty('RUNTIME', 'jitter', transform=lambda x: float(x), default="0.1")
 
     sentry_dsn = ConfigProperty('SENTRY', 'dsn')
 
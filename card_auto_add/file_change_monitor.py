@@ -0,0 +1,26 @@
+import os
+from typing import Optional, Tuple
+
+
+# Cheap check for whether a file has been written to since we last looked, based on its modification time and size.
+# Used to only query the Access databases when WinDSX has actually written something.
+class FileChangeMonitor(object):
+    def __init__(self, path):
+        self._path = path
+        self._signature: Optional[Tuple[int, int]] = self._read_signature()
+
+    def changed(self) -> bool:
+        signature = self._read_signature()
+        if signature is None or signature == self._signature:
+            return False
+
+        self._signature = signature
+        return True
+
+    def _read_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None  # Missing or locked, whoever is polling the file falls back to their timer
+
+        return stat.st_mtime_ns, stat.st_size
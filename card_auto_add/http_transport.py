@@ -0,0 +1,142 @@
+import random
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@dataclass
+class EndpointPolicy:
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    retries: int = 2
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+
+# Stops us from hammering (and waiting on) an endpoint that keeps failing. After failure_threshold failures in a row the
+# circuit opens and calls fail immediately for reset_timeout seconds, after which one call is let through to test it.
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if time.monotonic() - self._opened_at >= self._reset_timeout:
+                self._opened_at = time.monotonic()  # Let this one through, but keep everyone else out while it runs
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+# requests.Session wrapper that every outbound HTTP call should go through. Each named endpoint gets its own timeouts,
+# retry count and circuit breaker, connections are kept alive in a pool, and retries back off exponentially with jitter,
+# so a dead or slow server costs a bounded amount of time instead of hanging a thread forever.
+#
+# Only idempotent requests are retried after a response or read timeout. Anything else is only retried when we never
+# managed to connect, since otherwise the server may have already acted on it.
+class HttpTransport(object):
+    _idempotent_methods = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+    def __init__(self,
+                 pool_connections: int = 4,
+                 pool_maxsize: int = 8,
+                 backoff_base_seconds: float = 0.5,
+                 backoff_max_seconds: float = 10,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 60):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._backoff_base_seconds = backoff_base_seconds
+        self._backoff_max_seconds = backoff_max_seconds
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._policies: Dict[str, EndpointPolicy] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    def endpoint(self, name: str, connect_timeout: float = 5, read_timeout: float = 30, retries: int = 2):
+        self._policies[name] = EndpointPolicy(connect_timeout, read_timeout, retries)
+        self._breakers[name] = CircuitBreaker(self._failure_threshold, self._reset_timeout)
+
+    def get(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request(endpoint, "GET", url, **kwargs)
+
+    def post(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request(endpoint, "POST", url, **kwargs)
+
+    def request(self, endpoint: str, method: str, url: str, **kwargs) -> requests.Response:
+        if endpoint not in self._policies:
+            self.endpoint(endpoint)
+        policy = self._policies[endpoint]
+        breaker = self._breakers[endpoint]
+
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit for {endpoint} is open, not calling {url}")
+
+        kwargs.setdefault("timeout", policy.timeout)
+        idempotent = method.upper() in self._idempotent_methods
+
+        attempt = 0
+        while True:
+            try:
+                response = self._session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:  # Includes ConnectTimeout
+                should_retry = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt >= policy.retries or not should_retry:
+                    breaker.record_failure()
+                    raise
+            except requests.exceptions.Timeout:
+                if attempt >= policy.retries or not idempotent:
+                    breaker.record_failure()
+                    raise
+            else:
+                if response.status_code < 500 and response.status_code != 429:
+                    breaker.record_success()
+                    return response
+
+                if attempt >= policy.retries or not idempotent:
+                    breaker.record_failure()
+                    return response
+
+            attempt += 1
+            delay = min(self._backoff_max_seconds, self._backoff_base_seconds * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
@@ -1,37 +1,108 @@
+import hashlib
+import json
 import time
-from threading import Thread
-
-from sentry_sdk import capture_exception
+from typing import Dict, Iterator, Optional
 
 from card_auto_add.api import WebhookServerApi
 from card_auto_add.config import Config
+from card_auto_add.runtime import Runtime, PeriodicTask
 from card_auto_add.windsx.card_holders import WinDSXActiveCardHolders, CardHolder
 
 
 class ActiveCardsWatcher(object):
+    SYNC_INTERVAL = 5 * 60  # 5 minutes
+    FULL_SYNC_INTERVAL = 24 * 60 * 60  # 1 day
+
     def __init__(self, config: Config,
                  server_api: WebhookServerApi,
                  win_dsx_card_holders: WinDSXActiveCardHolders):
         self._config = config
+        self._logger = config.logger
         self._server_api = server_api
         self._win_dsx_card_holders = win_dsx_card_holders
 
-    def start(self):
-        thread = Thread(target=self._run, daemon=True)
-        thread.start()
+        # Card number -> hash of what the server has for that holder, as of our last successful upload
+        self._uploaded_hashes: Dict[str, bytes] = {}
+        self._last_full_sync: Optional[float] = None
+        self._full_sync_requested = False
+        self._changes_supported = True
+        self._task: Optional[PeriodicTask] = None
+
+    def start(self, runtime: Runtime):
+        self._task = runtime.every("active_cards_watcher", self._sync, self.SYNC_INTERVAL)
+
+    # Uploads every active card holder on the next sync, which starts right away. Safe to call from any thread, and from
+    # signal handlers.
+    def request_full_sync(self):
+        self._full_sync_requested = True
+        if self._task is not None:
+            self._task.trigger()
+
+    # Only the per card hashes are kept between syncs. Holders themselves are streamed from the database, and only the
+    # ones that changed are held in memory at once.
+    def _sync(self):
+        full_sync_due = self._full_sync_requested or \
+            self._last_full_sync is None or \
+            time.monotonic() - self._last_full_sync >= self.FULL_SYNC_INTERVAL
+
+        if self._full_sync_requested:
+            self._logger.info("Full active card holder sync requested")
+
+        if not full_sync_due:
+            hashes = {}
+            added = []
+            changed = []
+            for holder in self._holders():
+                holder_hash = self._hash(holder)
+                hashes[holder["card_num"]] = holder_hash
+
+                if holder["card_num"] not in self._uploaded_hashes:
+                    added.append(holder)
+                elif self._uploaded_hashes[holder["card_num"]] != holder_hash:
+                    changed.append(holder)
+            removed = [{"card_num": card} for card in self._uploaded_hashes if card not in hashes]
 
-    def _run(self):
-        while True:
-            # TODO remove hardcoded value
-            active_card_holders = self._win_dsx_card_holders.get_active_card_holders("denhac")
-            active_card_holders_dictionary = list(map(self._holder_to_dictionary, active_card_holders))
+            if len(added) == 0 and len(changed) == 0 and len(removed) == 0:
+                return
 
-            try:
-                self._server_api.submit_active_card_holders(active_card_holders_dictionary)
-            except Exception as e:
-                capture_exception(e)
+            if self._changes_supported:
+                result = self._server_api.submit_active_card_holder_changes(added, changed, removed)
 
-            time.sleep(8 * 60 * 60)  # 8 hours
+                if result is None:
+                    self._logger.info("Server doesn't support active card holder changes, sending the full list")
+                    self._changes_supported = False
+                elif result:
+                    self._uploaded_hashes = hashes
+                    return
+                else:
+                    return  # We'll figure out the changes again next time around
+
+        hashes = {}
+
+        def hashed_holders():
+            for holder in self._holders():
+                hashes[holder["card_num"]] = self._hash(holder)
+                yield holder
+
+        holders = hashed_holders()
+        try:
+            submitted = self._server_api.submit_active_card_holders(holders)
+        finally:
+            holders.close()  # Releases the database if the upload gave up partway through reading it
+
+        if submitted:
+            self._uploaded_hashes = hashes
+            self._last_full_sync = time.monotonic()
+            self._full_sync_requested = False
+
+    def _holders(self) -> Iterator[dict]:
+        # TODO remove hardcoded value
+        for card_holder in self._win_dsx_card_holders.get_active_card_holders("denhac"):
+            yield self._holder_to_dictionary(card_holder)
+
+    @staticmethod
+    def _hash(holder: dict) -> bytes:
+        return hashlib.sha1(json.dumps(holder, sort_keys=True).encode("utf-8")).digest()
 
     @staticmethod
     def _holder_to_dictionary(card_holder: CardHolder) -> dict:
@@ -1,51 +1,104 @@
-import time
 from datetime import datetime
-from threading import Thread
-from typing import List
+from typing import List, Optional
 
-from sentry_sdk import capture_exception
-
-from card_auto_add.api import WebhookServerApi
 from card_auto_add.config import Config
+from card_auto_add.file_change_monitor import FileChangeMonitor
+from card_auto_add.loops.scan_uploader import ScanUploader
+from card_auto_add.runtime import Runtime, PeriodicTask
+from card_auto_add.scan_spool import ScanSpool, ScanWatermark
 from card_auto_add.windsx.card_scan import WinDSXCardScan, CardScan
 
 
 class CardScanWatcher(object):
+    # If this many scans are waiting to be uploaded, stop reading new ones until the uploader catches up. They're safe in
+    # the log database in the meantime, since we only move past scans once they're in the spool.
+    SPOOL_HIGH_WATER_MARK = 10000
+
+    # We read scans as soon as WinDSX writes to the log database, the poll interval is just a safety net in case a write
+    # doesn't show up in the file's modification time or size.
+    LOG_CHANGE_CHECK_INTERVAL = 1
+    POLL_INTERVAL = 5 * 60
+
     def __init__(self, config: Config,
-                 server_api: WebhookServerApi,
-                 win_dsx_card_scan: WinDSXCardScan):
+                 win_dsx_card_scan: WinDSXCardScan,
+                 spool: ScanSpool,
+                 uploader: ScanUploader):
         self._config = config
         self._logger = config.logger
-        self._server_api = server_api
         self._win_dsx_card_scan = win_dsx_card_scan
+        self._spool = spool
+        self._uploader = uploader
         self._known_card_scans = {}
-        self._last_scan_time = datetime.now()
         self._devices = {}
+        self._log_db_monitor = FileChangeMonitor(config.log_db_path)
+        self._task: Optional[PeriodicTask] = None
+
+        # Pick up where we left off last time, including scans that happened while we weren't running
+        self._watermark = spool.watermark()
+        if self._watermark is None:
+            self._watermark = ScanWatermark(datetime.now())
+        else:
+            self._logger.info(f"Resuming card scans from {self._watermark.scan_time.isoformat()}")
+
+    def start(self, runtime: Runtime):
+        self._task = runtime.every("card_scan_watcher", self._poll, self.POLL_INTERVAL)
+        runtime.every("card_scan_log_monitor", self._check_log_db, self.LOG_CHANGE_CHECK_INTERVAL, jitter=0)
+
+    def _check_log_db(self):
+        if self._log_db_monitor.changed():
+            self._task.trigger()
+
+    def _poll(self):
+        if self._spool.depth >= self.SPOOL_HIGH_WATER_MARK:
+            self._logger.info(f"{self._spool.depth} card scans are waiting to be uploaded, not reading new ones")
+            return
+
+        self._read_scans()
+
+    def _read_scans(self):
+        read_any = False
+
+        # Each batch is spooled along with its watermark, so a long catch-up keeps what it has read even if it fails
+        for batch in self._win_dsx_card_scan.get_scan_events_since(self._watermark.scan_time):
+            read_any = self._spool_batch(batch) or read_any
+
+            if self._spool.depth >= self.SPOOL_HIGH_WATER_MARK:
+                break  # The rest waits for the uploader to catch up
+
+        if read_any:
+            self._uploader.notify()
 
-    def start(self):
-        thread = Thread(target=self._run, daemon=True)
-        thread.start()
+    def _spool_batch(self, batch: List[CardScan]) -> bool:
+        watermark = self._watermark
+        card_scans = [scan for scan in batch if not watermark.has_seen(scan.scan_time, scan.identity)]
 
-    def _run(self):
-        while True:
-            card_scans: List[CardScan] = self._win_dsx_card_scan.get_scan_events_since(self._last_scan_time)
+        for scan in card_scans:
+            if scan.device not in self._devices:
+                self._devices = self._win_dsx_card_scan.get_devices()
 
-            for scan in card_scans:
-                self._last_scan_time = max(self._last_scan_time, scan.scan_time)
+            name = self._devices[scan.device] if scan.device in self._devices else "Name Unknown"
 
-                if scan.device not in self._devices:
-                    self._devices = self._win_dsx_card_scan.get_devices()
+            if scan.access_allowed:
+                self._logger.info(f"ACCESS GRANTED Door={scan.device} Name=`{name}`")
+            else:
+                self._logger.info(f"ACCESS DENIED Door={scan.device} Name=`{name}`")
 
-                name = self._devices[scan.device] if scan.device in self._devices else "Name Unknown"
+        if len(card_scans) == 0:
+            return False
 
-                if scan.access_allowed:
-                    self._logger.info(f"ACCESS GRANTED Door={scan.device} Name=`{name}`")
-                else:
-                    self._logger.info(f"ACCESS DENIED Door={scan.device} Name=`{name}`")
+        watermark = watermark.advanced_past((scan.scan_time, scan.identity) for scan in card_scans)
+        self._spool.append([self._scan_to_dictionary(scan) for scan in card_scans], watermark)
+        self._watermark = watermark
 
-                try:
-                    self._server_api.submit_card_scan_event(scan)
-                except Exception as e:
-                    capture_exception(e)
+        return True
 
-            time.sleep(60)  # 1 minute
+    @staticmethod
+    def _scan_to_dictionary(card_scan: CardScan) -> dict:
+        return {
+            "first_name": card_scan.first_name,
+            "last_name": card_scan.last_name,
+            "card_num": card_scan.card,
+            "scan_time": card_scan.scan_time.isoformat(),
+            "access_allowed": card_scan.access_allowed,
+            "device": card_scan.device,
+        }
@@ -1,35 +1,30 @@
 import os
 import signal
 import subprocess
-import time
-from threading import Thread
 
 import psutil
 from sentry_sdk import capture_exception
 
 from card_auto_add.config import Config
+from card_auto_add.runtime import Runtime
 
 
 class CommServerWatcher(object):
     def __init__(self, config: Config):
         self._config = config
 
-    def start(self):
-        thread = Thread(target=self._run, daemon=True)
-        thread.start()
+    def start(self, runtime: Runtime):
+        runtime.every("comm_server_watcher", self._check, 60)  # 1 minute
 
-    def _run(self):
-        while True:
-            try:
-                cs_processes = [p for p in psutil.process_iter() if p.name() == 'cs.exe']
+    def _check(self):
+        try:
+            cs_processes = [p for p in psutil.process_iter() if p.name() == 'cs.exe']
 
-                if len(cs_processes) == 0:
-                    self._config.slack_logger.info("CS.exe was not running, so we will attempt to restart.")
-                    self._start_comm_server()
-            except BaseException as ex:
-                capture_exception(ex)
-
-            time.sleep(60)  # 1 minute
+            if len(cs_processes) == 0:
+                self._config.slack_logger.info("CS.exe was not running, so we will attempt to restart.")
+                self._start_comm_server()
+        except Exception as ex:
+            capture_exception(ex)
 
     def restart_comm_server(self):
         self._config.slack_logger.info("Attempting to restart Comm Server")
@@ -1,14 +1,11 @@
 import json
-import time
 from dataclasses import dataclass
-from threading import Thread, Lock
-
-import requests
-from pysherplus.authentication import URLAuthentication
-from pysherplus.pusher import PusherHost, Pusher
+from threading import Lock
 
+from card_auto_add.broadcasting import create_pusher
 from card_auto_add.config import Config
-from card_auto_add.windsx.door_override import DoorOverride
+from card_auto_add.runtime import Runtime
+from card_auto_add.windsx.door_override import DoorOverride, DoorState
 
 
 @dataclass
@@ -23,32 +20,46 @@ class DoorOverrideWatcher(object):
         self._logger = config.logger
         self._door_states = {}
         self._update_lock = Lock()
+        self._door_override = DoorOverride()
 
-        session = requests.Session()
-        session.headers["Authorization"] = f"Bearer {self._config.ingester_api_key}"
-        self.auth = URLAuthentication("https://webhooks.denhac.org/broadcasting/auth", session)
-        pusher_host = PusherHost.from_url("https://ws.webhooks.denhac.org/app/denhac")
-
-        self._pusher = Pusher(pusher_host, authenticator=self.auth)
+        self._pusher = create_pusher(config)
         self._pusher["private-doors"]['App\\Events\\DoorControlUpdated'].register(self._on_door_update)
 
-    def start(self):
-        thread = Thread(target=self._run, daemon=True)
-        thread.start()
-
-    def _run(self):
+    def start(self, runtime: Runtime):
         self._pusher.connect()
+        runtime.on_shutdown(self._shutdown)
 
-        while True:
-            time.sleep(1)
-            with self._update_lock:
-                for device_id, door in list(self._door_states.items()):
-                    door.duration = door.duration - 1
+        # Door durations count down once a second, jitter would just make them drift. Its own thread, so that doors
+        # close on time no matter what the other tasks are stuck on.
+        runtime.every("door_override_watcher", self._tick, 1, jitter=0, dedicated_thread=True)
+
+    def _tick(self):
+        with self._update_lock:
+            expired = []
+            for device_id, door in self._door_states.items():
+                door.duration = door.duration - 1
 
-                    if door.duration <= 0:
-                        DoorOverride.time_zone(device_id)
-                        del self._door_states[device_id]
-                        self._logger.info(f"Closed door {device_id}")
+                if door.duration <= 0:
+                    expired.append(device_id)
+
+            # If this fails, the doors stay expired and we try again next tick
+            self._door_override.set_states((device_id, DoorState.TIME_ZONE) for device_id in expired)
+            for device_id in expired:
+                del self._door_states[device_id]
+                self._logger.info(f"Closed door {device_id}")
+
+    # Don't leave doors propped open just because we stopped counting them down
+    def _shutdown(self):
+        self._pusher.disconnect()
+
+        with self._update_lock:
+            device_ids = list(self._door_states.keys())
+            self._door_override.set_states((device_id, DoorState.TIME_ZONE) for device_id in device_ids)
+            for device_id in device_ids:
+                del self._door_states[device_id]
+                self._logger.info(f"Closed door {device_id} on shutdown")
+
+        self._door_override.close()
 
     def _on_door_update(self, _,  data):
         data = json.loads(data)
@@ -57,16 +68,20 @@ class DoorOverrideWatcher(object):
 
         try:
             with self._update_lock:
+                # Every door in the update goes to the Comm Server in one batch
+                self._door_override.set_states(
+                    (door_update["device"], DoorState.OPEN if door_update["open"] else DoorState.TIME_ZONE)
+                    for door_update in doors
+                )
+
                 for door_update in doors:
                     device_id = door_update["device"]
                     should_open = door_update["open"]
 
                     if should_open:
                         self._logger.info(f"Opening device {device_id}")
-                        DoorOverride.open(device_id)
                     else:
                         self._logger.info(f"Closing device {device_id}")
-                        DoorOverride.time_zone(device_id)
 
                         # If we're closing this door, duration no longer matters, remove it from our list
                         if device_id in self._door_states:
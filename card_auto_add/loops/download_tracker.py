@@ -0,0 +1,243 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import List, Optional, Set, Tuple
+
+from sentry_sdk import capture_exception
+
+from card_auto_add.config import Config
+from card_auto_add.data_signing import DataSigning
+from card_auto_add.http_transport import HttpTransport
+from card_auto_add.loops.comm_server_watcher import CommServerWatcher
+from card_auto_add.runtime import Runtime, PeriodicTask
+from card_auto_add.windsx.database import Database
+
+
+@dataclass
+class DownloadScope:
+    # The rows that changed and need to reach the hardware. Each of them should already have its DlFlag set.
+    card_ids: Set[int] = field(default_factory=set)
+    acls: Set[int] = field(default_factory=set)
+    device_groups: Set[int] = field(default_factory=set)
+
+    def merge(self, other: "DownloadScope"):
+        self.card_ids |= other.card_ids
+        self.acls |= other.acls
+        self.device_groups |= other.device_groups
+
+
+@dataclass
+class DownloadGeneration:
+    number: int
+    futures: List[Future]
+    scope: Optional[DownloadScope]  # None while doing a full download
+    polls: int = 0  # Polls since the current phase (incremental, or the latest full attempt) started
+    attempts: int = 0  # Full download attempts that timed out
+
+
+class DownloadTracker(object):
+    _poll_interval = 10  # seconds between checks of the LOC download flag
+    _polls_per_attempt = 30  # 30 * 10 == 300 seconds to wait for the download before resetting
+    _max_attempts = 5  # We'll endure up to 5 attempts, 4 resets
+
+    _incremental_poll_interval = 2  # seconds between checks of the per row download flags
+    _incremental_polls = 60  # 60 * 2 == 120 seconds before we give up and fall back to a full download
+    _max_ids_per_query = 100
+
+    _idle_interval = 60  # Nothing to watch, request_download wakes us up early anyway
+
+    def __init__(self,
+                 config: Config,
+                 acs_db: Database,
+                 comm_server_watcher: CommServerWatcher):
+        self._config = config
+        self._acs_db = acs_db
+        self._comm_server_watcher = comm_server_watcher
+        self._log = config.logger
+        self._slack_log = config.slack_logger
+        self._data_signing = DataSigning(config.dsxpi_signing_secret)
+        self._transport = HttpTransport(pool_connections=1, pool_maxsize=1)
+        self._transport.endpoint("dsxpi_reset", connect_timeout=5, read_timeout=60, retries=1)
+
+        self._lock = Lock()
+        self._queued: List[Tuple[Future, Optional[DownloadScope]]] = []
+        self._generation_count = 0
+        self._current: Optional[DownloadGeneration] = None
+        self._task: Optional[PeriodicTask] = None
+
+    def start(self, runtime: Runtime):
+        self._task = runtime.every("download_tracker", self._tick, self._next_tick_interval, jitter=0)
+
+    # Returns a future that resolves once a download that started after this call has completed, or fails if the
+    # Comm Server never finishes it. Requests made while a download is in progress are rolled into the next one, since
+    # the running download may have already read past the changes they were made for.
+    #
+    # With a scope, only those rows are pushed and we wait on their own download flags, falling back to a full download
+    # if they never clear. Without one (or if any request in the generation has none), everything is downloaded.
+    def request_download(self, scope: Optional[DownloadScope] = None) -> Future:
+        future = Future()
+        with self._lock:
+            self._queued.append((future, scope))
+
+        if self._task is not None:
+            self._task.trigger()
+
+        return future
+
+    def _next_tick_interval(self):
+        if self._current is None:
+            return self._idle_interval
+        if self._current.scope is not None:
+            return self._incremental_poll_interval
+        return self._poll_interval
+
+    # Each tick does one small step: start a download generation, or check on the running one. That way nothing here
+    # ever blocks for the minutes a download can take.
+    def _tick(self):
+        generation = self._current
+
+        try:
+            if generation is None:
+                self._start_next_generation()
+            elif generation.scope is not None:
+                self._check_incremental(generation)
+            else:
+                self._check_full(generation)
+        except Exception as e:
+            generation = self._current
+            self._current = None
+            if generation is not None:
+                for future in generation.futures:
+                    future.set_exception(e)
+            raise
+
+    def _start_next_generation(self):
+        with self._lock:
+            waiting = self._queued
+            self._queued = []
+
+        if len(waiting) == 0:
+            return
+
+        scope = DownloadScope()
+        for _, request_scope in waiting:
+            if request_scope is None:
+                scope = None
+                break
+            scope.merge(request_scope)
+
+        self._generation_count += 1
+        self._current = DownloadGeneration(self._generation_count, [future for future, _ in waiting], scope)
+
+        kind = "full" if scope is None else "incremental"
+        self._log.info(f"Starting {kind} download generation {self._generation_count} for {len(waiting)} request(s)")
+
+        if scope is None:
+            self._request_full_download()
+        else:
+            self._request_incremental_download()
+
+    def _finish(self, generation: DownloadGeneration):
+        self._current = None
+        for future in generation.futures:
+            future.set_result(generation.number)
+
+        # Anything that was queued while this one ran can start right away
+        self._task.trigger()
+
+    def _request_incremental_download(self):
+        # The changed rows already have DlFlag set, so we only have to let the Comm Server know this location has
+        # something waiting. Notably we don't touch FullDlFlag or zero the checksums, which is what forces a full push.
+        with self._acs_db.transaction() as cursor:
+            cursor.execute("UPDATE LOC SET DlFlag=1")
+
+    def _check_incremental(self, generation: DownloadGeneration):
+        pending = self._pending_rows(generation.scope)
+        if pending == 0:
+            self._log.info("Incremental update went through")
+            self._finish(generation)
+            return
+
+        generation.polls += 1
+        if generation.polls < self._incremental_polls:
+            self._log.info(f"{pending} changed row(s) still waiting to be downloaded")
+            return
+
+        self._log.info("Incremental update timed out, falling back to a full download")
+        generation.scope = None
+        generation.polls = 0
+        self._request_full_download()
+
+    def _pending_rows(self, scope: DownloadScope) -> int:
+        pending = 0
+        with self._acs_db.read() as cursor:
+            for table, column, ids in (("LocCards", "CardID", scope.card_ids),
+                                       ("ACL", "Acl", scope.acls),
+                                       ("DGRP", "DGrp", scope.device_groups)):
+                ids = list(ids)
+                for i in range(0, len(ids), self._max_ids_per_query):
+                    chunk = ids[i:i + self._max_ids_per_query]
+                    placeholders = ", ".join("?" * len(chunk))
+                    pending += cursor.execute(
+                        f"SELECT COUNT(*) FROM {table} WHERE DlFlag = 1 AND {column} IN ({placeholders})",
+                        chunk
+                    ).fetchval()
+
+        return pending
+
+    def _request_full_download(self):
+        with self._acs_db.transaction() as cursor:
+            cursor.execute("UPDATE DEV SET DlFlag=1, CkSum=0")
+            cursor.execute("UPDATE IO SET DlFlag=1")
+            cursor.execute(
+                "UPDATE LOC SET PlFlag=True, DlFlag=1, FullDlFlag=True, NodeCs=0, CodeCs=0, AclCs=0, DGrpCs=0"
+            )
+
+        self._log.info("Comm Server update requested")
+
+    def _check_full(self, generation: DownloadGeneration):
+        with self._acs_db.read() as cursor:
+            downloading = cursor.execute("SELECT FullDlFlag FROM LOC").fetchval()
+
+        if not downloading:
+            self._log.info("Looks like everything updated!")
+            self._finish(generation)
+            return
+
+        generation.polls += 1
+        if generation.polls < self._polls_per_attempt:
+            self._log.info("Update doesn't look like it's gone through yet, waiting 10 seconds")
+            return
+
+        generation.polls = 0
+        generation.attempts += 1
+
+        self._log.info("Update timed out")
+        self._slack_log.info("Card update timed out, will attempt to reset and try again.")
+        self._reset_card_access_hardware()
+
+        if generation.attempts >= 2:
+            self._comm_server_watcher.restart_comm_server()
+
+        if generation.attempts >= self._max_attempts:
+            self._log.info("Card update failed after too many attempts")
+            self._slack_log.info("Card update failed after too many attempts")
+
+            raise Exception("Comm Server update timed out")
+
+    def _reset_card_access_hardware(self):
+        signed_payload = self._data_signing.encode(10)
+        url = f"{self._config.dsxpi_host}/reset/{signed_payload}"
+        try:
+            response = self._transport.post("dsxpi_reset", url)
+        except Exception as e:
+            capture_exception(e)
+            self._slack_log.info(f"Could not reach DSXPI to restart the hardware: {e}")
+            return
+
+        self._slack_log.info(response.content.decode('ascii'))
+
+        if not response.ok:
+            self._slack_log.info("DSXPI hardware failed to restart")
+        else:
+            self._slack_log.info("DSXPI hardware looks like it restarted!")
@@ -1,11 +1,17 @@
 import threading
-import time
-from threading import Thread
+from concurrent.futures import Future
+from functools import partial
+from typing import Optional
 
 from sentry_sdk import capture_exception
 
 from card_auto_add.api import WebhookServerApi
+from card_auto_add.broadcasting import create_pusher
 from card_auto_add.config import Config
+from card_auto_add.loops.status_reporter import StatusReporter
+from card_auto_add.retry_queue import RetryQueue
+from card_auto_add.runtime import Runtime, PeriodicTask
+from card_auto_add.update_journal import UpdateJournal
 from card_auto_add.windsx.activations import WinDSXCardActivations, CardInfo
 
 
@@ -13,73 +19,217 @@ class Ingester(object):
     STATUS_SUCCESS = "success"
     STATUS_NOT_DONE = "not_done"
 
+    METHOD_ENABLE = "enable"
+    METHOD_DISABLE = "disable"
+
+    # Pushed events wake us up right away, so polling is only a safety net while the socket is connected
+    POLL_INTERVAL_CONNECTED = 15 * 60
+    POLL_INTERVAL_DISCONNECTED = 60
+
     def __init__(self, config: Config,
                  win_dsx_card_activations: WinDSXCardActivations,
-                 server_api: WebhookServerApi):
+                 server_api: WebhookServerApi,
+                 status_reporter: StatusReporter,
+                 journal: UpdateJournal,
+                 retry_queue: RetryQueue):
         self._win_dsx_card_activations = win_dsx_card_activations
 
-        self._request_lock = threading.Lock()
-        self._known_requests = set()
+        # Guards the in flight set, retry queue and journal. Download callbacks take it from the download tracker's thread,
+        # or from ours if the download was already done, hence reentrant.
+        self._request_lock = threading.RLock()
+        self._journal = journal
+        self._in_flight_requests = set()  # Updates we've started on but haven't reported a status for yet
+        self._retry_queue = retry_queue
 
         self._server_api = server_api
+        self._status_reporter = status_reporter
 
         self._logger = config.logger
+        self._slack_logger = config.slack_logger
 
-    def start(self):
-        thread = Thread(target=self._run, daemon=True)
-        thread.start()
+        self._task: Optional[PeriodicTask] = None
+        self._pusher = create_pusher(config)
+        self._pusher["private-card-updates"]['App\\Events\\CardUpdateRequested'].register(self._on_card_update_pushed)
 
-    def _run(self):
-        while True:
-            updates = []
+    def start(self, runtime: Runtime):
+        self._pusher.connect()
+        runtime.on_shutdown(self._pusher.disconnect)
+
+        self._task = runtime.every("ingester", self._poll, self._seconds_until_next_poll)
+
+    def _poll(self):
+        updates = []
+        try:
+            updates = self._server_api.get_command_json()
+        except Exception as e:
+            self._logger.exception("Failed getting updates", exc_info=True)
+            capture_exception(e)
+
+        self._handle_updates(updates or [])
+
+    def _seconds_until_next_poll(self):
+        interval = self.POLL_INTERVAL_CONNECTED if self._pusher.connected else self.POLL_INTERVAL_DISCONNECTED
+
+        next_retry = self._retry_queue.seconds_until_next_due()
+        if next_retry is not None:
+            interval = min(interval, next_retry)
+
+        return interval
+
+    def _on_card_update_pushed(self, *_):
+        # The event just tells us there's something new, we still fetch the updates themselves over HTTP
+        if self._task is not None:
+            self._task.trigger()
+
+    def _handle_updates(self, updates):
+        with self._request_lock:
+            pending = []
+            for update in updates:
+                update_id = update["id"]
+
+                if update_id in self._in_flight_requests:
+                    continue
+
+                if update_id in self._journal:
+                    # We're done with it, but the server is still listing it, so our status never made it there
+                    status = self._journal.status_of(update_id)
+                    self._logger.info(f"Update {update_id} was already processed, sending its status {status} again")
+                    self._status_reporter.submit(update_id, status)
+                    continue
+
+                self._in_flight_requests.add(update_id)
+
+                try:
+                    pending.append((update_id, self._parse_update(update)))
+                except Exception as e:
+                    self._logger.exception(f"Could not parse update {update_id}", exc_info=True)
+                    capture_exception(e)
+                    self._submit_status(update_id, self.STATUS_NOT_DONE)
+
+            pending.extend(self._retry_queue.pop_due())
+            if self._retry_queue.depth > 0:
+                self._logger.info(f"{self._retry_queue.depth} update(s) waiting to be retried")
+
+            if len(pending) == 0:
+                return
+
+            self._logger.info(f"Processing {len(pending)} update(s) as one batch")
+            self._announce(pending)
+            handled = set()
             try:
-                updates = self._server_api.get_command_json()
+                with self._win_dsx_card_activations.transaction():
+                    applied, changed = self._apply_batch(pending, handled)
             except Exception as e:
-                self._logger.exception("Failed getting updates", exc_info=True)
+                self._logger.exception("Could not commit batch of updates", exc_info=True)
                 capture_exception(e)
+                # Whatever didn't already fail on its own has to be retried too, or it would stay in flight forever
+                for update_id, parsed in pending:
+                    if update_id not in handled:
+                        self._retry_or_give_up(update_id, parsed)
+                return
 
-            for update in updates or []:
-                self._maybe_handle_request(update)
+            if len(applied) == 0:
+                return
 
-            time.sleep(60)
+            if not changed:
+                self._logger.info("Nothing in this batch changed what the hardware knows, skipping the download")
+                self._report_applied(applied)
+                return
 
-    def _maybe_handle_request(self, update):
-        with self._request_lock:
-            update_id = update["id"]
+            download = self._win_dsx_card_activations.request_download()
 
-            if update_id in self._known_requests:
-                return
+            # We don't wait on the hardware download here, so the next poll can start preparing its changes while the
+            # Comm Server works. Statuses get reported once the download finishes or fails.
+            download.add_done_callback(partial(self._on_batch_downloaded, applied))
 
-            self._known_requests.add(update_id)
+    def _on_batch_downloaded(self, applied, download: Future):
+        error = download.exception()
 
-            try:
-                self._logger.info(f"Processing update {update_id}")
-
-                method = update["method"]
-                card_info = CardInfo(
-                    first_name=update["first_name"].replace("'", ""),
-                    last_name=update["last_name"].replace("'", ""),
-                    company=update["company"],
-                    woo_id=update["woo_id"],
-                    card=update["card"]
-                )
-
-                if method == "enable":
-                    self._win_dsx_card_activations.activate(card_info)
-                elif method == "disable":
-                    self._win_dsx_card_activations.deactivate(card_info)
-                else:
-                    raise ValueError(f"Method {method} for update {update_id} is unknown")
-
-                self._submit_status(update_id, self.STATUS_SUCCESS)
+        with self._request_lock:
+            if error is None:
+                self._report_applied(applied)
+                return
 
-            except Exception as e:
-                self._logger.exception(f"Could not process update {update_id}", exc_info=True)
-                capture_exception(e)
-                self._submit_status(update_id, self.STATUS_NOT_DONE)
+            self._logger.info(f"Hardware download failed for {len(applied)} update(s): {error}")
+            for update_id, parsed in applied:
+                self._retry_or_give_up(update_id, parsed)
+
+        # Our next poll may be a while off, so let it figure out when the first retry is due
+        self._task.trigger()
+
+    # Once per update per batch, _apply_batch may replay an update several times
+    def _announce(self, pending):
+        for _, (method, card_info) in pending:
+            action = "Activating" if method == self.METHOD_ENABLE else "Deactivating"
+            self._slack_logger.info(f"{action} card {card_info.card} for {card_info.first_name} {card_info.last_name}")
+
+    def _report_applied(self, applied):
+        for update_id, (method, card_info) in applied:
+            action = "activated" if method == self.METHOD_ENABLE else "deactivated"
+            self._slack_logger.info(f"Card {card_info.card} {action} for {card_info.first_name} {card_info.last_name}")
+            self._submit_status(update_id, self.STATUS_SUCCESS)
+
+    def _parse_update(self, update):
+        update_id = update["id"]
+        method = update["method"]
+
+        if method not in (self.METHOD_ENABLE, self.METHOD_DISABLE):
+            raise ValueError(f"Method {method} for update {update_id} is unknown")
+
+        card_info = CardInfo(
+            first_name=update["first_name"].replace("'", ""),
+            last_name=update["last_name"].replace("'", ""),
+            company=update["company"],
+            woo_id=update["woo_id"],
+            card=update["card"]
+        )
+
+        return method, card_info
+
+    def _apply_batch(self, pending, handled: set):
+        # Everything in a batch shares one transaction. Access doesn't give us savepoints, so if any update
+        # fails we roll the whole transaction back, drop that update, and replay the rest from the start.
+        # Updates that failed and were already retried or given up on are added to handled.
+        remaining = list(pending)
+        while True:
+            failed = None
+            changed = False
+            for update_id, parsed in remaining:
+                method, card_info = parsed
+                try:
+                    self._logger.info(f"Processing update {update_id}")
+
+                    if method == self.METHOD_ENABLE:
+                        changed |= self._win_dsx_card_activations.activate(card_info, update_system=False)
+                    else:
+                        changed |= self._win_dsx_card_activations.deactivate(card_info, update_system=False)
+                except Exception as e:
+                    self._logger.exception(f"Could not process update {update_id}", exc_info=True)
+                    capture_exception(e)
+                    failed = (update_id, parsed)
+                    break
+
+            if failed is None:
+                return remaining, changed
+
+            self._retry_or_give_up(*failed)
+            handled.add(failed[0])
+            self._win_dsx_card_activations.rollback()
+            remaining = [item for item in remaining if item[0] != failed[0]]
+
+    def _retry_or_give_up(self, update_id, parsed):
+        if self._retry_queue.schedule(update_id, parsed):
+            self._logger.info(f"Update {update_id} failed {self._retry_queue.failures(update_id)} time(s), "
+                              f"will retry ({self._retry_queue.depth} waiting)")
+            return
+
+        self._slack_logger.info(f"Giving up on update {update_id} after too many failed attempts")
+        self._submit_status(update_id, self.STATUS_NOT_DONE)
 
     def _submit_status(self, update_id, status):
-        try:
-            self._server_api.submit_status(update_id, status)
-        except Exception as e:
-            capture_exception(e)
+        # Journal first so there's never a moment where the update is neither in flight nor known as processed
+        self._journal.record(update_id, status)
+        self._in_flight_requests.discard(update_id)
+        self._retry_queue.forget(update_id)
+
+        self._status_reporter.submit(update_id, status)
@@ -0,0 +1,76 @@
+from typing import Optional
+
+from card_auto_add.api import WebhookServerApi
+from card_auto_add.config import Config
+from card_auto_add.runtime import Runtime, PeriodicTask
+from card_auto_add.scan_spool import ScanSpool
+
+
+# Drains the scan spool to the webhook server in batches. A burst of scans costs one request, and if the server is down
+# the scans just wait in the spool while we back off.
+class ScanUploader(object):
+    _batch_size = 100
+    _idle_wait_seconds = 30
+    _retry_delay_seconds = 5
+    _max_retry_delay_seconds = 5 * 60
+
+    def __init__(self, config: Config, server_api: WebhookServerApi, spool: ScanSpool):
+        self._logger = config.logger
+        self._server_api = server_api
+        self._spool = spool
+        self._batch_supported = True
+        self._consecutive_failures = 0
+        self._task: Optional[PeriodicTask] = None
+
+    def start(self, runtime: Runtime):
+        self._task = runtime.every("scan_uploader", self._upload, self._next_upload_interval)
+
+    # Called after scans are added to the spool so they go out right away
+    def notify(self):
+        if self._task is not None:
+            self._task.trigger()
+
+    def _next_upload_interval(self):
+        if self._consecutive_failures > 0:
+            return min(self._max_retry_delay_seconds,
+                       self._retry_delay_seconds * (2 ** (self._consecutive_failures - 1)))
+
+        if self._spool.depth > 0:
+            return 0  # Still more to send
+
+        return self._idle_wait_seconds
+
+    def _upload(self):
+        sent_everything = False
+        try:
+            sent_everything = self._upload_batch()
+        finally:
+            if sent_everything:
+                self._consecutive_failures = 0
+            else:
+                self._consecutive_failures += 1
+                self._logger.info(f"Could not upload card scans, {self._spool.depth} waiting")
+
+    def _upload_batch(self) -> bool:
+        batch = self._spool.peek(self._batch_size)
+        if len(batch) == 0:
+            return True
+
+        if self._batch_supported:
+            result = self._server_api.submit_card_scan_events([payload for _, payload in batch])
+
+            if result is None:
+                self._logger.info("Server doesn't support batched card scans, sending them one at a time")
+                self._batch_supported = False
+            elif result:
+                self._spool.remove([spool_id for spool_id, _ in batch])
+                return True
+            else:
+                return False
+
+        for spool_id, payload in batch:
+            if not self._server_api.submit_card_scan_event(payload):
+                return False
+            self._spool.remove([spool_id])
+
+        return True
@@ -0,0 +1,112 @@
+from dataclasses import dataclass
+from queue import Queue, Empty
+from typing import List, Optional
+
+from sentry_sdk import capture_message
+
+from card_auto_add.api import WebhookServerApi
+from card_auto_add.config import Config
+from card_auto_add.runtime import Runtime, PeriodicTask
+
+
+@dataclass
+class PendingStatus:
+    update_id: object
+    status: str
+    attempts: int = 0
+
+
+# Sends card update statuses to the webhook server from its own runtime task, so nothing that processes cards ever waits
+# on HTTP. Whatever has queued up is sent together in one request when the server supports it, and failed sends are
+# retried with a growing delay a bounded number of times.
+class StatusReporter(object):
+    _max_attempts = 5
+    _max_batch_size = 50
+    _retry_delay_seconds = 15
+    _max_retry_delay_seconds = 10 * 60
+    _idle_interval = 60  # submit wakes us up early anyway
+
+    def __init__(self, config: Config, server_api: WebhookServerApi):
+        self._logger = config.logger
+        self._server_api = server_api
+        self._queue: Queue = Queue()
+        self._batch_supported = True
+        self._consecutive_failures = 0
+        self._task: Optional[PeriodicTask] = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self, runtime: Runtime):
+        self._task = runtime.every("status_reporter", self._drain, self._next_drain_interval)
+
+    def submit(self, update_id, status):
+        self._queue.put(PendingStatus(update_id, status))
+
+        # While we're backing off from failures, new statuses wait for the retry like everything else
+        if self._task is not None and self._consecutive_failures == 0:
+            self._task.trigger()
+
+    def _next_drain_interval(self):
+        if self._consecutive_failures > 0:
+            return min(self._max_retry_delay_seconds,
+                       self._retry_delay_seconds * (2 ** (self._consecutive_failures - 1)))
+
+        if not self._queue.empty():
+            return 0
+
+        return self._idle_interval
+
+    def _drain(self):
+        batch = self._take_batch()
+        if len(batch) == 0:
+            return
+
+        try:
+            failed = self._send(batch)
+        except Exception:
+            self._handle_failed(batch)
+            raise
+
+        self._handle_failed(failed)
+
+    def _handle_failed(self, failed: List[PendingStatus]):
+        if len(failed) == 0:
+            self._consecutive_failures = 0
+            return
+
+        self._consecutive_failures += 1
+        for pending in failed:
+            pending.attempts += 1
+            if pending.attempts >= self._max_attempts:
+                self._logger.info(f"Giving up on reporting status {pending.status} for update {pending.update_id}")
+                capture_message(f"Could not report status {pending.status} for update {pending.update_id}")
+            else:
+                self._queue.put(pending)
+
+    def _take_batch(self) -> List[PendingStatus]:
+        by_update = {}
+        while len(by_update) < self._max_batch_size:
+            try:
+                pending = self._queue.get_nowait()
+            except Empty:
+                break
+            # If an update was reported twice, only the latest status matters
+            by_update[pending.update_id] = pending
+
+        return list(by_update.values())
+
+    def _send(self, batch: List[PendingStatus]) -> List[PendingStatus]:
+        if self._batch_supported and len(batch) > 1:
+            result = self._server_api.submit_statuses([(pending.update_id, pending.status) for pending in batch])
+
+            if result is None:
+                self._logger.info("Server doesn't support batched statuses, sending them one at a time")
+                self._batch_supported = False
+            elif result:
+                return []
+            else:
+                return batch
+
+        return [pending for pending in batch if not self._server_api.submit_status(pending.update_id, pending.status)]
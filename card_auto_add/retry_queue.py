@@ -0,0 +1,68 @@
+import random
+import time
+from threading import Lock
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+# Holds work that failed so it can be tried again later. Each failure pushes the next attempt further out (exponential
+# backoff with jitter, so a batch that failed together doesn't retry in lockstep) until max_attempts is reached.
+class RetryQueue(object):
+    def __init__(self,
+                 base_delay_seconds: float = 60,
+                 max_delay_seconds: float = 60 * 60,
+                 max_attempts: int = 5):
+        self._base_delay_seconds = base_delay_seconds
+        self._max_delay_seconds = max_delay_seconds
+        self._max_attempts = max_attempts
+
+        self._lock = Lock()
+        self._failures: Dict[Hashable, int] = {}
+        self._waiting: Dict[Hashable, Tuple[float, Any]] = {}
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiting)
+
+    def seconds_until_next_due(self) -> Optional[float]:
+        with self._lock:
+            if len(self._waiting) == 0:
+                return None
+            next_due = min(due_at for due_at, _ in self._waiting.values())
+
+        return max(0.0, next_due - time.monotonic())
+
+    def failures(self, key) -> int:
+        return self._failures.get(key, 0)
+
+    # Returns False if the item has used up all of its attempts, in which case it's forgotten instead of queued
+    def schedule(self, key, item) -> bool:
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+
+            if failures >= self._max_attempts:
+                self._failures.pop(key, None)
+                self._waiting.pop(key, None)
+                return False
+
+            delay = min(self._max_delay_seconds, self._base_delay_seconds * (2 ** (failures - 1)))
+            delay = random.uniform(delay / 2, delay)
+
+            self._failures[key] = failures
+            self._waiting[key] = (time.monotonic() + delay, item)
+
+            return True
+
+    def pop_due(self) -> List[Tuple[Hashable, Any]]:
+        now = time.monotonic()
+
+        with self._lock:
+            due = [(key, item) for key, (due_at, item) in self._waiting.items() if due_at <= now]
+            for key, _ in due:
+                del self._waiting[key]
+
+        return due
+
+    def forget(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._waiting.pop(key, None)
@@ -0,0 +1,152 @@
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Callable, List, Optional, Union
+
+from sentry_sdk import capture_exception
+
+from card_auto_add.config import Config
+
+Interval = Union[float, Callable[[], float]]
+
+
+class PeriodicTask(object):
+    def __init__(self, runtime: "Runtime", name: str, func: Callable[[], None], interval: Interval, jitter: float,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        self._runtime = runtime
+        self.name = name
+        self._func = func
+        self._interval = interval
+        self._jitter = jitter
+        self._executor = executor  # None runs on the runtime's shared pool
+        self._wake: Optional[asyncio.Event] = None
+
+    @property
+    def dedicated(self) -> bool:
+        return self._executor is not None
+
+    # Runs the task as soon as possible instead of waiting out its interval. Safe to call from any thread.
+    def trigger(self):
+        self._runtime.call_soon(self._set_wake)
+
+    def _set_wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self, logger: Logger):
+        self._wake = asyncio.Event()
+
+        while True:
+            # Cleared before running, so a trigger that comes in while we're busy gets us to run again right after
+            self._wake.clear()
+
+            try:
+                await self._runtime.run_blocking_on(self._executor, self._func)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Task {self.name} failed", exc_info=True)
+                capture_exception(e)
+
+            delay = self._interval() if callable(self._interval) else self._interval
+            delay += random.uniform(0, delay * self._jitter)
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Runs all of our periodic work from one asyncio event loop. Task bodies are ordinary blocking functions (pyodbc, sockets,
+# HTTP), so they run on a bounded thread pool, but when and how often they run is decided in one place. stop() cancels
+# everything and run() returns, instead of the process being killed with daemon threads mid-flight.
+#
+# The shared pool always has at least one thread per task on it, so tasks stuck on slow I/O can't starve the rest.
+# Tasks that must never wait behind anything else (like closing propped open doors) can ask for a thread of their own.
+#
+# A task's interval can be overridden with "<task name> = <seconds>" in the [INTERVALS] config section.
+class Runtime(object):
+    def __init__(self, config: Config):
+        self._config = config
+        self._logger = config.logger
+        self._jitter = config.runtime_jitter
+        self._executor: Optional[ThreadPoolExecutor] = None  # Sized once we know how many tasks share it
+        self._dedicated_executors: List[ThreadPoolExecutor] = []
+        self._loop = asyncio.new_event_loop()
+        self._tasks: List[PeriodicTask] = []
+        self._shutdown_callbacks: List[Callable[[], None]] = []
+        self._stop_requested: Optional[asyncio.Event] = None
+
+    def every(self, name: str, func: Callable[[], None], interval: Interval,
+              jitter: Optional[float] = None, dedicated_thread: bool = False) -> PeriodicTask:
+        if not callable(interval):
+            interval = self._config.task_interval(name, interval)
+
+        executor = None
+        if dedicated_thread:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"card_access_{name}")
+            self._dedicated_executors.append(executor)
+
+        task = PeriodicTask(self, name, func, interval, self._jitter if jitter is None else jitter, executor)
+        self._tasks.append(task)
+
+        return task
+
+    def on_shutdown(self, callback: Callable[[], None]):
+        self._shutdown_callbacks.append(callback)
+
+    def run_blocking(self, func, *args):
+        return self.run_blocking_on(None, func, *args)
+
+    # Runs func on the given executor, or on the shared pool if that's None
+    def run_blocking_on(self, executor: Optional[ThreadPoolExecutor], func, *args):
+        return self._loop.run_in_executor(self._shared_executor() if executor is None else executor, func, *args)
+
+    def _shared_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            shared_tasks = sum(1 for task in self._tasks if not task.dedicated)
+            self._executor = ThreadPoolExecutor(max_workers=max(self._config.runtime_max_workers, shared_tasks),
+                                                thread_name_prefix="card_access")
+        return self._executor
+
+    def call_soon(self, callback):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(callback)
+
+    # Safe to call from any thread, including signal handlers
+    def stop(self):
+        self.call_soon(self._request_stop)
+
+    def _request_stop(self):
+        if self._stop_requested is not None:
+            self._stop_requested.set()
+
+    def run(self):
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+            for executor in [self._executor] + self._dedicated_executors:
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _main(self):
+        self._stop_requested = asyncio.Event()
+
+        running = [asyncio.ensure_future(task.run(self._logger)) for task in self._tasks]
+
+        await self._stop_requested.wait()
+        self._logger.info("Shutting down")
+
+        for future in running:
+            future.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+        # Cancelled tasks can still be stuck on a pool thread, so callbacks run on the loop's own executor instead
+        for callback in self._shutdown_callbacks:
+            try:
+                await asyncio.wait_for(self._loop.run_in_executor(None, callback), timeout=10)
+            except Exception as e:
+                self._logger.exception("Shutdown callback failed", exc_info=True)
+                capture_exception(e)
@@ -0,0 +1,122 @@
+import json
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock
+from typing import FrozenSet, Iterable, List, Optional, Tuple
+
+
+# How far into the log database we've read. Scans at exactly scan_time are told apart by their identity, since several
+# can share a timestamp and the next query has to include that timestamp again to not miss any of them.
+@dataclass(frozen=True)
+class ScanWatermark:
+    scan_time: datetime
+    seen: FrozenSet[tuple] = field(default_factory=frozenset)
+
+    def has_seen(self, scan_time: datetime, identity: tuple) -> bool:
+        return scan_time < self.scan_time or (scan_time == self.scan_time and identity in self.seen)
+
+    def advanced_past(self, scans: Iterable[Tuple[datetime, tuple]]) -> "ScanWatermark":
+        scan_time = self.scan_time
+        seen = set(self.seen)
+
+        for time, identity in scans:
+            if time > scan_time:
+                scan_time = time
+                seen = {identity}
+            elif time == scan_time:
+                seen.add(identity)
+
+        return ScanWatermark(scan_time, frozenset(seen))
+
+
+# Durable first-in first-out queue of card scan events waiting to be uploaded. Scans are written here as soon as we read
+# them from the log database, and are only removed once the server has accepted them, so a webhook outage or a restart
+# doesn't lose anything.
+#
+# The scan watcher's watermark is stored alongside the scans and written in the same transaction, so after a restart we
+# resume exactly where the spool left off, without skipping or re-reading scans.
+class ScanSpool(object):
+    def __init__(self, path):
+        self._lock = Lock()
+
+        # Appended to by the scan watcher and drained by the uploader, always under self._lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+                CREATE TABLE IF NOT EXISTS spooled_scans (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL
+                )
+            """
+        )
+        self._connection.execute(
+            """
+                CREATE TABLE IF NOT EXISTS scan_watermark (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    scan_time TEXT NOT NULL,
+                    seen TEXT NOT NULL
+                )
+            """
+        )
+        self._connection.commit()
+
+        self._depth = self._connection.execute("SELECT COUNT(*) FROM spooled_scans").fetchone()[0]
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def watermark(self) -> Optional[ScanWatermark]:
+        with self._lock:
+            row = self._connection.execute("SELECT scan_time, seen FROM scan_watermark WHERE id = 1").fetchone()
+
+        if row is None:
+            return None
+
+        scan_time, seen = row
+        return ScanWatermark(
+            scan_time=datetime.fromisoformat(scan_time),
+            seen=frozenset(tuple(identity) for identity in json.loads(seen))
+        )
+
+    def append(self, payloads: List[dict], watermark: Optional[ScanWatermark] = None):
+        if len(payloads) == 0 and watermark is None:
+            return
+
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO spooled_scans(payload) VALUES (?)",
+                    [(json.dumps(payload),) for payload in payloads]
+                )
+
+                if watermark is not None:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO scan_watermark(id, scan_time, seen) VALUES (1, ?, ?)",
+                        (watermark.scan_time.isoformat(), json.dumps([list(identity) for identity in watermark.seen]))
+                    )
+            self._depth += len(payloads)
+
+    def peek(self, limit: int) -> List[Tuple[int, dict]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, payload FROM spooled_scans ORDER BY id LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+        return [(spool_id, json.loads(payload)) for spool_id, payload in rows]
+
+    def remove(self, spool_ids: List[int]):
+        if len(spool_ids) == 0:
+            return
+
+        with self._lock:
+            with self._connection:
+                removed = self._connection.executemany(
+                    "DELETE FROM spooled_scans WHERE id = ?",
+                    [(spool_id,) for spool_id in spool_ids]
+                ).rowcount
+            self._depth -= removed
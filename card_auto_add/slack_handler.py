@@ -1,13 +1,15 @@
 import logging
 from datetime import datetime, timezone
 
-import requests
+from card_auto_add.http_transport import HttpTransport
 
 
 class SlackHandler(logging.Handler):
     def __init__(self, webhook_url):
         super().__init__()
         self._webhook_url = webhook_url
+        self._transport = HttpTransport(pool_connections=1, pool_maxsize=2)
+        self._transport.endpoint("slack", connect_timeout=5, read_timeout=10, retries=1)
 
     def emit(self, record: logging.LogRecord) -> None:
         payload = {
@@ -22,4 +24,7 @@ class SlackHandler(logging.Handler):
             ]
         }
 
-        requests.post(self._webhook_url, json=payload)
+        try:
+            self._transport.post("slack", self._webhook_url, json=payload)
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,97 @@
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+
+# Remembers which card updates we've already finished and what status we reported for them, so updates aren't
+# processed again after a restart. Entries live in a small SQLite file and in a bounded in-memory copy; anything older
+# than max_age_seconds or beyond the newest max_entries is dropped from both.
+class UpdateJournal(object):
+    def __init__(self, path,
+                 max_entries: int = 10000,
+                 max_age_seconds: int = 30 * 24 * 60 * 60):
+        self._max_entries = max_entries
+        self._max_age_seconds = max_age_seconds
+        self._lock = Lock()
+
+        # Written from the ingester thread and from download callbacks, always under self._lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            """
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    processed_at REAL NOT NULL
+                )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS processed_updates_processed_at ON processed_updates(processed_at)"
+        )
+        self._connection.commit()
+
+        self._entries: OrderedDict = OrderedDict()
+        self._load()
+
+    def __contains__(self, update_id) -> bool:
+        return str(update_id) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def status_of(self, update_id) -> Optional[str]:
+        entry = self._entries.get(str(update_id))
+        return None if entry is None else entry[0]
+
+    def record(self, update_id, status):
+        update_id = str(update_id)
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO processed_updates(update_id, status, processed_at) VALUES (?, ?, ?)",
+                (update_id, status, now)
+            )
+            self._entries[update_id] = (status, now)
+            self._entries.move_to_end(update_id)
+
+            self._evict(now)
+            self._connection.commit()
+
+    def _load(self):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM processed_updates WHERE processed_at < ?",
+                (time.time() - self._max_age_seconds,)
+            )
+
+            rows = self._connection.execute(
+                "SELECT update_id, status, processed_at FROM processed_updates ORDER BY processed_at DESC LIMIT ?",
+                (self._max_entries,)
+            ).fetchall()
+
+            for update_id, status, processed_at in reversed(rows):
+                self._entries[update_id] = (status, processed_at)
+
+            self._connection.execute(
+                "DELETE FROM processed_updates WHERE processed_at < ?",
+                (rows[-1][2] if len(rows) == self._max_entries else 0,)
+            )
+            self._connection.commit()
+
+    def _evict(self, now):
+        cutoff = now - self._max_age_seconds
+
+        evicted = []
+        while len(self._entries) > 0:
+            update_id, (_, processed_at) = next(iter(self._entries.items()))
+            if len(self._entries) <= self._max_entries and processed_at >= cutoff:
+                break
+
+            self._entries.popitem(last=False)
+            evicted.append((update_id,))
+
+        if len(evicted) > 0:
+            self._connection.executemany("DELETE FROM processed_updates WHERE update_id = ?", evicted)
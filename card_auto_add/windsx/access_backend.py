@@ -0,0 +1,17 @@
+import pyodbc
+
+
+# Connects to a WinDSX Access database through the Microsoft Access ODBC driver, which only exists on Windows
+class AccessBackend(object):
+    def __init__(self, db_path):
+        self._db_path = db_path
+
+    def connect(self, read_only: bool) -> pyodbc.Connection:
+        connection_string = (
+            r'DRIVER={Microsoft Access Driver (*.mdb)};'
+            r'DBQ=' + str(self._db_path) + ";"
+        )
+        if read_only:
+            return pyodbc.connect(connection_string + "ReadOnly=1;", autocommit=True)
+
+        return pyodbc.connect(connection_string)
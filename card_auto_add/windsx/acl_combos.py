@@ -0,0 +1,80 @@
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+
+from card_auto_add.windsx.database import Database
+
+
+# In memory view of AclGrpCombo, mapping the set of ACL name IDs in a combo to its combo ID and back. The table is
+# loaded once and kept up to date as we add combos. refresh_if_changed compares a cheap row count/max combo ID
+# signature against the last one we saw and reloads if someone else (WinDSX itself) changed the table.
+#
+# The signature can't see a combo being edited in place, so the rows of a combo are read again before we hand it out,
+# and the whole table is reloaded if they don't match what we have.
+class AclComboIndex(object):
+    def __init__(self, acs_db: Database):
+        self._acs_db = acs_db
+        self._combo_by_name_ids: Dict[FrozenSet[int], int] = {}
+        self._name_ids_by_combo: Dict[int, FrozenSet[int]] = {}
+        self._signature: Optional[Tuple] = None
+
+    def refresh_if_changed(self):
+        signature = self._read_signature()
+
+        if signature != self._signature:
+            self._load()
+            self._signature = signature
+
+    def invalidate(self):
+        self._signature = None
+
+    def combo_for(self, name_ids: Iterable[int]) -> Optional[int]:
+        name_ids = frozenset(name_ids)
+        combo_id = self._combo_by_name_ids.get(name_ids)
+
+        if combo_id is not None and self._read_combo(combo_id) != name_ids:
+            self._reload()
+            combo_id = self._combo_by_name_ids.get(name_ids)
+
+        return combo_id
+
+    def name_ids_for(self, combo_id) -> FrozenSet[int]:
+        name_ids = self._read_combo(combo_id)
+
+        if name_ids != self._name_ids_by_combo.get(combo_id, frozenset()):
+            self._reload()
+
+        return name_ids
+
+    def add(self, combo_id, name_ids: Iterable[int]):
+        name_ids = frozenset(name_ids)
+        self._combo_by_name_ids[name_ids] = combo_id
+        self._name_ids_by_combo[combo_id] = name_ids
+        # Our own inserts change the signature, and we don't want them to force a reload
+        self._signature = self._read_signature()
+
+    def _read_combo(self, combo_id) -> FrozenSet[int]:
+        rows = self._acs_db.cursor.execute(
+            "SELECT AclGrpNameID FROM AclGrpCombo WHERE ComboID = ?",
+            combo_id
+        ).fetchall()
+        return frozenset(row.AclGrpNameID for row in rows)
+
+    def _reload(self):
+        self._load()
+        self._signature = self._read_signature()
+
+    def _read_signature(self):
+        return tuple(self._acs_db.cursor.execute("SELECT COUNT(*), MAX(ComboID) FROM AclGrpCombo").fetchone())
+
+    def _load(self):
+        grouped = defaultdict(set)
+        for row in self._acs_db.cursor.execute("SELECT AclGrpNameID, ComboID FROM AclGrpCombo"):
+            if row.ComboID is not None:
+                grouped[row.ComboID].add(row.AclGrpNameID)
+
+        self._name_ids_by_combo = {combo_id: frozenset(name_ids) for combo_id, name_ids in grouped.items()}
+
+        # If the same set of ACLs shows up under more than one combo, consistently pick the oldest one
+        self._combo_by_name_ids = {}
+        for combo_id in sorted(self._name_ids_by_combo, reverse=True):
+            self._combo_by_name_ids[self._name_ids_by_combo[combo_id]] = combo_id
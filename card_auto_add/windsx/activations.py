@@ -1,16 +1,16 @@
-import time
 import uuid
 from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
-from itertools import groupby
-from typing import Union, Optional
-
-import requests
+from typing import Iterator, Union, Optional
 
 from card_auto_add.config import Config
-from card_auto_add.data_signing import DataSigning
-from card_auto_add.loops.comm_server_watcher import CommServerWatcher
+from card_auto_add.loops.download_tracker import DownloadTracker, DownloadScope
+from card_auto_add.windsx.acl_combos import AclComboIndex
 from card_auto_add.windsx.database import Database
+from card_auto_add.windsx.device_groups import DeviceGroupIndex
+from card_auto_add.windsx.reference_data import ReferenceDataCache
 
 
 class CardInfo(object):
@@ -33,73 +33,180 @@ class WinDSXCardActivations(object):
     def __init__(self,
                  config: Config,
                  acs_db: Database,
-                 comm_server_watcher: CommServerWatcher,
+                 download_tracker: DownloadTracker,
+                 reference_data: ReferenceDataCache,
                  ):
         self._acs_db: Database = acs_db
         self._config: Config = config
         self._default_acl = config.windsx_acl
         self._log = config.logger
         self._slack_log = config.slack_logger
-        self._data_signing = DataSigning(config.dsxpi_signing_secret)
-        self._comm_server_watcher = comm_server_watcher
+        self._download_tracker = download_tracker
+        self._full_downloads = config.download_mode == "full"
+        self._download_scope = DownloadScope()  # What the current transaction has changed
+        self._reference_data = reference_data
+        self._acl_combos = AclComboIndex(acs_db)
+        self._device_groups = DeviceGroupIndex(acs_db)
 
         self._loc_grp = 3  # TODO Look this up based on the name
         self._udf_name = "ID"  # TODO Look this up in config
 
-    def activate(self, card_info: CardInfo):
+    # Returns whether anything that the hardware cares about changed. If not, there's no reason to pay for a download.
+    def activate(self, card_info: CardInfo, update_system: bool = True) -> bool:
+        self._check_can_update_system(update_system)
         self._log.info(f"Activating card {card_info.card}")
-        self._slack_log.info(f"Activating card {card_info.card} for {card_info.first_name} {card_info.last_name}")
+        if update_system:
+            # Batched callers announce their updates themselves, so replays don't repeat the message
+            self._slack_log.info(f"Activating card {card_info.card} for {card_info.first_name} {card_info.last_name}")
+
+        with self.transaction():
+            changed = self._activate(card_info)
+
+        if update_system:
+            self._finish_single_update(changed)
+            self._slack_log.info(f"Card {card_info.card} activated for {card_info.first_name} {card_info.last_name}")
 
+        return changed
+
+    def _activate(self, card_info: CardInfo) -> bool:
         acl_name_id = self._get_acl_by_name(self._default_acl)
+        self._acl_combos.refresh_if_changed()
 
         name_id = self._find_or_create_name(card_info)
 
-        card_id, card_combo_id = self._get_card_combo_id(card_info.card)
+        card = self._get_card(card_info.card)
+        changed = False
 
-        if card_id is None:
+        if card is None:
             # This should give us the card combo id with just our acl
             card_combo_id = self._find_or_create_new_combo_id(None, acl_name_id)
             card_id = self._create_card(name_id, card_info.card, card_combo_id)
+            changed = True
         else:
+            card_id = card.ID
+            card_combo_id = card.AclGrpComboId
             new_card_combo_id = self._get_card_combo_containing_acl(card_combo_id, acl_name_id)
 
             if card_combo_id != new_card_combo_id:
                 self._log.info(f"Updating card combo id from {card_combo_id} to {new_card_combo_id}")
                 self._update_card_combo_id(card_id, new_card_combo_id)
                 card_combo_id = new_card_combo_id
+                changed = True
 
-            self._set_card_active(card_id, name_id)
+            if card.Status and card.NameID == name_id and card.StopDate == self._date_never:
+                self._log.info(f"Card id {card_id} is already active")
+            else:
+                self._set_card_active(card_id, name_id)
+                changed = True
 
         acl_ids = self._find_or_create_acl_id(card_combo_id)
         self._log.info(f"Using ACL IDs: {acl_ids}")
 
-        self._create_or_update_loc_cards(card_id, acl_ids)
-
-        self._encourage_system_update()
+        loc_card = self._get_loc_card(card_id)
+        if loc_card is None or self._loc_card_acls(loc_card) != acl_ids:
+            # Written with DlFlag already set
+            self._create_or_update_loc_cards(card_id, loc_card, acl_ids)
+            self._download_scope.card_ids.add(card_id)
+            changed = True
+        elif self._loc_card_pending(loc_card):
+            # Committed before, but the download for it failed. The retry has to ask for one again.
+            self._log.info(f"LocCard id {loc_card.ID} has the right ACLs, but hasn't been downloaded yet")
+            self._download_scope.card_ids.add(card_id)
+            changed = True
+        elif changed:
+            # Some changes (like the card's status) don't touch LocCards, but that's the row the hardware gets its
+            # cards from.
+            self._flag_loc_cards_for_download(card_id)
+        else:
+            self._log.info(f"Card {card_info.card} was already activated, no download needed")
 
-        self._slack_log.info(f"Card {card_info.card} activated for {card_info.first_name} {card_info.last_name}")
+        return changed
 
-    def deactivate(self, card_info: CardInfo):
+    # Returns whether anything that the hardware cares about changed. If not, there's no reason to pay for a download.
+    def deactivate(self, card_info: CardInfo, update_system: bool = True) -> bool:
+        self._check_can_update_system(update_system)
         self._log.info(f"Deactivating card {card_info.card}")
-        self._slack_log.info(f"Deactivating card {card_info.card} for {card_info.first_name} {card_info.last_name}")
-
-        card_id, _ = self._get_card_combo_id(card_info.card)
-
-        if card_id is None:
-            self._log.info(f"Card id not found for {card_info.card}, so it's safe to assume it never was activated")
-            return
-
-        self._set_card_inactive(card_id)
-
-        self._encourage_system_update()
-
-        self._slack_log.info(f"Card {card_info.card} deactivated for {card_info.first_name} {card_info.last_name}")
+        if update_system:
+            self._slack_log.info(f"Deactivating card {card_info.card} for {card_info.first_name} {card_info.last_name}")
+
+        with self.transaction():
+            card = self._get_card(card_info.card)
+
+            if card is None:
+                self._log.info(f"Card id not found for {card_info.card}, so it's safe to assume it never was activated")
+                return False
+
+            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            if not card.Status and card.StopDate is not None and card.StopDate <= today:
+                loc_card = self._get_loc_card(card.ID)
+                if loc_card is None or not self._loc_card_pending(loc_card):
+                    self._log.info(f"Card {card_info.card} was already deactivated, no download needed")
+                    return False
+
+                self._log.info(f"Card {card_info.card} was already deactivated, but hasn't been downloaded yet")
+                self._download_scope.card_ids.add(card.ID)  # Still flagged, it just has to be part of the download
+            else:
+                self._set_card_inactive(card.ID)
+
+        if update_system:
+            self._finish_single_update(True)
+            self._slack_log.info(f"Card {card_info.card} deactivated for {card_info.first_name} {card_info.last_name}")
+
+        return True
+
+    # Waiting on a download while our transaction holds the writer would deadlock the download tracker, and the download
+    # would go out before anything was committed
+    def _check_can_update_system(self, update_system: bool):
+        if update_system and self._acs_db.in_transaction:
+            raise RuntimeError("update_system=True can't be used inside a transaction, request_download() after it")
+
+    def _finish_single_update(self, changed):
+        if changed:
+            self.request_download().result()
+
+    # activate/deactivate each run in their own transaction, unless they're called inside this one. Wrapping several of
+    # them (with update_system=False) lets a caller commit them together and pay for a single hardware download. The
+    # transaction commits when the block exits cleanly and rolls back if it raises.
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        outermost = not self._acs_db.in_transaction
+
+        with self._acs_db.transaction():
+            if outermost:
+                self._download_scope = DownloadScope()
+
+            try:
+                yield
+            except BaseException:
+                if outermost:
+                    self._forget_changes()
+                raise
+
+    # Undoes everything the current transaction has done so far, but stays inside of it
+    def rollback(self):
+        self._acs_db.rollback()
+        self._forget_changes()
+
+    def _forget_changes(self):
+        self._download_scope = DownloadScope()
+        # These may know about combos/device groups that were never committed
+        self._acl_combos.invalidate()
+        self._device_groups.invalidate()
+        # And whatever failed may have failed on reference data that changed since we cached it
+        self._reference_data.invalidate()
+
+    # Asks for what the last committed transaction changed to be pushed out to the hardware. The returned future
+    # resolves once the Comm Server has done so.
+    def request_download(self) -> Future:
+        scope = self._download_scope
+        self._download_scope = DownloadScope()
+        return self._download_tracker.request_download(None if self._full_downloads else scope)
 
     def _find_or_create_name(self, card_info: CardInfo):
         # First, let's try to find it via uuid5
         customer_uuid = str(uuid.uuid5(uuid.NAMESPACE_OID, str(card_info.user_id)))
 
-        udf_num = self._acs_db.cursor.execute("SELECT UdfNum FROM UdfName WHERE Name = ?", self._udf_name).fetchval()
+        udf_num = self._reference_data.udf_num(self._udf_name)
 
         if udf_num is None:
             raise ValueError(f"Failed to find UDF Name ID {self._udf_name}")
@@ -113,8 +220,7 @@ class WinDSXCardActivations(object):
             self._log.info(f"Found name id {name_id} based on customer id {card_info.user_id}")
             return name_id
 
-        company_id = self._acs_db.cursor.execute("SELECT Company from COMPANY WHERE Name = ?",
-                                                 card_info.company).fetchval()
+        company_id = self._reference_data.company_id(card_info.company)
 
         if company_id is None:
             raise ValueError(f"No company found for company name '{card_info.company}'")
@@ -163,13 +269,8 @@ class WinDSXCardActivations(object):
                 (self._loc_grp, name_id, udf_num, customer_uuid)
             )
 
-        self._acs_db.connection.commit()
-
     def _get_acl_by_name(self, acl_name):
-        sql = "SELECT ID FROM AclGrpName WHERE Name = ?"
-
-        self._acs_db.cursor.execute(sql, acl_name)
-        acl_name_id = self._acs_db.cursor.fetchval()
+        acl_name_id = self._reference_data.acl_name_id(acl_name)
 
         if acl_name_id is None:
             raise ValueError(f"Could not find acl named {acl_name}")
@@ -177,24 +278,21 @@ class WinDSXCardActivations(object):
         self._log.info(f"Found ACL Name ID: {acl_name_id}")
         return acl_name_id
 
-    def _get_card_combo_id(self, card_num: Union[str, int]):
+    def _get_card(self, card_num: Union[str, int]):
         if not isinstance(card_num, str):
             card_num = str(card_num)
 
-        sql = "SELECT ID, AclGrpComboId FROM `CARDS` WHERE Code = ?"
+        sql = "SELECT ID, AclGrpComboId, NameID, Status, StopDate FROM `CARDS` WHERE Code = ?"
 
         self._acs_db.cursor.execute(sql, card_num.lstrip('0'))
         row = self._acs_db.cursor.fetchone()
 
         if row is None:
             self._log.info(f"No existing card was found for card {card_num}")
-            return None, None
         else:
-            card_id = row.ID
-            card_combo_id = row.AclGrpComboId
-            self._log.info(f"Found card id {card_id} and combo id {card_combo_id} for card {card_num}")
+            self._log.info(f"Found card id {row.ID} and combo id {row.AclGrpComboId} for card {card_num}")
 
-            return card_id, card_combo_id
+        return row
 
     def _get_card_combo_containing_acl(self, card_combo_id, acl_name_id):
         if self._combo_contains_name_id(card_combo_id, acl_name_id):
@@ -207,27 +305,19 @@ class WinDSXCardActivations(object):
         return card_combo_id
 
     def _combo_contains_name_id(self, card_combo_id, acl_name_id):
-        sql = "SELECT AclGrpNameID FROM AclGrpCombo WHERE ComboID = ?"
-        name_ids = [x[0] for x in self._acs_db.cursor.execute(sql, card_combo_id)]
-
-        return acl_name_id in name_ids
+        return acl_name_id in self._acl_combos.name_ids_for(card_combo_id)
 
     def _find_or_create_new_combo_id(self, base_card_combo_id: Optional[int], acl_name_id):
         if base_card_combo_id is None:
             known_name_ids = set()
         else:
-            sql = "SELECT AclGrpNameID FROM AclGrpCombo WHERE ComboID = ?"
-            known_name_ids = set([x[0] for x in self._acs_db.cursor.execute(sql, base_card_combo_id)])
+            known_name_ids = set(self._acl_combos.name_ids_for(base_card_combo_id))
 
         known_name_ids.add(acl_name_id)
 
-        acl_combos = list(self._acs_db.cursor.execute("SELECT AclGrpNameID, ComboID FROM AclGrpCombo"))
-        grouped_by_combo_id = groupby(acl_combos, lambda x: x.ComboID)
-
-        for new_combo_id, value in grouped_by_combo_id:
-            acl_name_ids = set([x[0] for x in value])
-            if acl_name_ids == known_name_ids:
-                return new_combo_id
+        new_combo_id = self._acl_combos.combo_for(known_name_ids)
+        if new_combo_id is not None:
+            return new_combo_id
 
         self._log.info("We didn't find a valid combo id, will create one.")
 
@@ -244,7 +334,7 @@ class WinDSXCardActivations(object):
                 (name_id, new_combo_id, self._loc_grp)
             )
 
-        self._acs_db.connection.commit()
+        self._acl_combos.add(new_combo_id, known_name_ids)
 
         return new_combo_id
 
@@ -266,8 +356,6 @@ class WinDSXCardActivations(object):
         if card_id is None:
             raise ValueError(f"Card ID could not be retrieved on created card for card {card_num}")
 
-        self._acs_db.connection.commit()
-
         self._log.info(f"Created card with card id {card_id}")
 
         return card_id
@@ -277,14 +365,12 @@ class WinDSXCardActivations(object):
             "UPDATE CARDS SET AclGrpComboID = ?, DlFlag = 0 WHERE ID = ?",
             (new_card_combo_id, card_id)
         )
-        self._acs_db.connection.commit()
 
     def _set_card_active(self, card_id, name_id):
         self._acs_db.cursor.execute(
             "UPDATE CARDS SET NameID = ?, StartDate = ?, StopDate = ?, DlFlag = 0, Status = True WHERE ID = ?",
             (name_id, datetime.now(), self._date_never, card_id)
         )
-        self._acs_db.connection.commit()
 
     def _set_card_inactive(self, card_id):
         today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
@@ -293,8 +379,11 @@ class WinDSXCardActivations(object):
             (today, card_id)
         )
 
+        self._flag_loc_cards_for_download(card_id)
+
+    def _flag_loc_cards_for_download(self, card_id):
         self._acs_db.cursor.execute("UPDATE LocCards SET DlFlag = 1, CkSum = 0 WHERE CardID = ?", card_id)
-        self._acs_db.connection.commit()
+        self._download_scope.card_ids.add(card_id)
 
     def _find_or_create_acl_id(self, card_combo_id):
         device_access = self._acs_db.cursor.execute(
@@ -317,10 +406,10 @@ class WinDSXCardActivations(object):
             if access.Tz4 != 0:
                 tz_to_dev_list[access.Tz4].add(access.Dev)
 
-        device_groups = list(self._acs_db.cursor.execute("SELECT * FROM DGRP").fetchall())
+        self._device_groups.refresh_if_changed()
         tz_to_device_group = {}
         for tz, dev_list in tz_to_dev_list.items():
-            tz_to_device_group[tz] = self._find_or_create_matching_device_group(dev_list, device_groups)
+            tz_to_device_group[tz] = self._find_or_create_matching_device_group(dev_list)
 
         acls = set()
         for tz, device_group in tz_to_device_group.items():
@@ -328,41 +417,20 @@ class WinDSXCardActivations(object):
 
         return acls
 
-    def _find_or_create_matching_device_group(self, dev_list, device_groups):
-        for group in device_groups:
-            valid_group = True
-            for dev in range(128):
-                device_on = dev in dev_list  # Do we need this device
-                group_device_on = getattr(group, f"D{dev}")  # Is this device set to true
-
-                if device_on != group_device_on:  # Those values must match for a valid group
-                    valid_group = False
-                    break
+    def _find_or_create_matching_device_group(self, dev_list):
+        mask = DeviceGroupIndex.mask_for(dev_list)
 
-            if valid_group:
-                self._log.info(f"Found a valid device group {group.DGrp}")
-                return group.DGrp
+        device_group = self._device_groups.find(mask)
+        if device_group is not None:
+            self._log.info(f"Found a valid device group {device_group}")
+            return device_group
 
         self._log.info("No valid device group found, creating one")
+        device_group = self._device_groups.create(mask)
+        self._download_scope.device_groups.add(device_group)
+        self._log.info(f"Created device group {device_group}")
 
-        group_names = self._acs_db.cursor.execute("SELECT DGrp FROM DGRP").fetchall()
-        device_group = max([int(x.DGrp) for x in group_names if float.is_integer(x.DGrp)]) + 1  # Grab the next one
-
-        sql = "INSERT INTO DGRP(DGrp, DlFlag, CkSum"
-        for i in range(128):
-            sql += f", D{i}"
-
-        sql += ") VALUES ("
-        for i in range(128 + 3):  # 128 devices + 3 fields above
-            sql += f", ?"
-        sql += ")"
-
-        values = [device_group, 1, 0]
-        for i in range(128):
-            values.append(i in dev_list)
-
-        self._acs_db.cursor.execute(sql, values)
-        self._acs_db.connection.commit()
+        return device_group
 
     def _find_or_create_matching_acl(self, tz, device_group):
         acl = self._acs_db.cursor.execute("SELECT Acl FROM ACL WHERE Tz = ? AND DGrp = ?",
@@ -374,18 +442,35 @@ class WinDSXCardActivations(object):
         self._log.info(f"Acl not found for Tz {tz} and device group {device_group}, creating one")
 
         acl_names = self._acs_db.cursor.execute("SELECT Acl FROM ACL").fetchall()
-        acl = max([int(x.DGrp) for x in acl_names if float.is_integer(x.DGrp)]) + 1  # Grab the next one
+        acl = max([int(x.Acl) for x in acl_names if float(x.Acl).is_integer()]) + 1  # Grab the next one
 
         self._acs_db.cursor.execute(
             "INSERT INTO ACL(Loc, Acl, Tz, DGrp, DlFlag, CkSum) VALUES (?, ?, ?, ?, ?, ?)",
             (self._loc_grp, acl, tz, device_group, 1, 0)
         )
-        self._acs_db.connection.commit()
+        self._download_scope.acls.add(acl)
 
         return acl
 
-    def _create_or_update_loc_cards(self, card_id, acl_ids):
-        loc_card_id = self._acs_db.cursor.execute("SELECT ID FROM LocCards WHERE CardID = ?", card_id).fetchval()
+    def _get_loc_card(self, card_id):
+        return self._acs_db.cursor.execute(
+            "SELECT ID, DlFlag, Acl, Acl1, Acl2, Acl3, Acl4 FROM LocCards WHERE CardID = ?",
+            card_id
+        ).fetchone()
+
+    # Still flagged from an earlier change that never made it to the hardware
+    @staticmethod
+    def _loc_card_pending(loc_card) -> bool:
+        return loc_card.DlFlag == 1
+
+    @staticmethod
+    def _loc_card_acls(loc_card):
+        return set(acl for acl in (loc_card.Acl, loc_card.Acl1, loc_card.Acl2, loc_card.Acl3, loc_card.Acl4)
+                   if acl != -1)
+
+    def _create_or_update_loc_cards(self, card_id, loc_card, acl_ids):
+        acl_ids = set(acl_ids)
+        loc_card_id = None if loc_card is None else loc_card.ID
 
         acl = acl1 = acl2 = acl3 = acl4 = -1
         if acl_ids:
@@ -412,50 +497,3 @@ class WinDSXCardActivations(object):
                 "VAlUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (self._loc_grp, card_id, 1, 0, acl, acl1, acl2, acl3, acl4)
             )
-
-        self._acs_db.connection.commit()
-
-    def _encourage_system_update(self):
-        self._acs_db.cursor.execute("UPDATE DEV SET DlFlag=1, CkSum=0")
-        self._acs_db.cursor.execute("UPDATE IO SET DlFlag=1")
-        self._acs_db.cursor.execute(
-            "UPDATE LOC SET PlFlag=True, DlFlag=1, FullDlFlag=True, NodeCs=0, CodeCs=0, AclCs=0, DGrpCs=0"
-        )
-
-        self._acs_db.connection.commit()
-
-        self._log.info("Comm Server update requested")
-        for j in range(5):  # We'll endure up to 5 attempts, 4 resets
-            for i in range(30):  # We'll endure 30 * 10 == 300 seconds to wait for the update before resetting
-                downloading = self._acs_db.cursor.execute("SELECT FullDlFlag FROM LOC").fetchval()
-
-                if not downloading:
-                    self._log.info("Looks like everything updated!")
-                    return
-
-                self._log.info("Update doesn't look like it's gone through yet, waiting 10 seconds")
-                time.sleep(10)
-
-            self._log.info("Update timed out")
-            self._slack_log.info("Card update timed out, will attempt to reset and try again.")
-            self._reset_card_access_hardware()
-
-            if j >= 1:
-                self._comm_server_watcher.restart_comm_server()
-
-        self._log.info("Card update failed after too many attempts")
-        self._slack_log.info("Card update failed after too many attempts")
-
-        raise Exception("Comm Server update timed out")
-
-    def _reset_card_access_hardware(self):
-        signed_payload = self._data_signing.encode(10)
-        url = f"{self._config.dsxpi_host}/reset/{signed_payload}"
-        response = requests.post(url)
-
-        self._slack_log.info(response.content.decode('ascii'))
-
-        if not response.ok:
-            self._slack_log.info("DSXPI hardware failed to restart")
-        else:
-            self._slack_log.info("DSXPI hardware looks like it restarted!")
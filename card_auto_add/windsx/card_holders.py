@@ -1,9 +1,9 @@
-from typing import List
-
-from card_auto_add.windsx.database import Database
+from typing import Iterator
 
 
 class CardHolder(object):
+    __slots__ = ("name_id", "first_name", "last_name", "company", "card", "card_active")
+
     def __init__(self,
                  name_id,
                  first_name,
@@ -20,10 +20,15 @@ class CardHolder(object):
 
 
 class WinDSXActiveCardHolders(object):
-    def __init__(self, acs_db: Database):
-        self._acs_db: Database = acs_db
+    _fetch_size = 500
+
+    # acs_db only needs read(), a SnapshotReader keeps this join off the live database
+    def __init__(self, acs_db):
+        self._acs_db = acs_db
 
-    def get_active_card_holders(self, company_name) -> List[CardHolder]:
+    # Streams card holders from the database rather than building a list of all of them. The cursor stays open until the
+    # generator is exhausted or closed.
+    def get_active_card_holders(self, company_name) -> Iterator[CardHolder]:
         sql = \
             """
                 SELECT
@@ -49,18 +54,20 @@ class WinDSXActiveCardHolders(object):
                     AND CA.Status = true
             """
 
-        with self._acs_db.lock:
-            rows = list(self._acs_db.cursor.execute(sql, company_name))
+        with self._acs_db.read() as cursor:
+            cursor.execute(sql, company_name)
 
-            card_holders = []
-            for row in rows:
-                card_holders.append(CardHolder(
-                    name_id=row.NameId,
-                    first_name=row.FirstName,
-                    last_name=row.LastName,
-                    company=row.CompanyName,
-                    card=str(row.CardCode).strip('0').rstrip('.'),
-                    card_active=row.CardStatus
-                ))
+            while True:
+                rows = cursor.fetchmany(self._fetch_size)
+                if len(rows) == 0:
+                    break
 
-            return card_holders
+                for row in rows:
+                    yield CardHolder(
+                        name_id=row.NameId,
+                        first_name=row.FirstName,
+                        last_name=row.LastName,
+                        company=row.CompanyName,
+                        card=str(row.CardCode).strip('0').rstrip('.'),
+                        card_active=row.CardStatus
+                    )
@@ -1,7 +1,14 @@
+from typing import Iterator, List
+
 from card_auto_add.windsx.database import Database
+from card_auto_add.windsx.name_info import NameInfoCache
+from card_auto_add.windsx.reference_data import ReferenceDataCache
 
 
 class CardScan(object):
+    __slots__ = ("name_id", "first_name", "last_name", "company", "card", "scan_time", "access_allowed", "device",
+                 "identity")
+
     def __init__(self,
                  name_id,
                  first_name,
@@ -10,7 +17,8 @@ class CardScan(object):
                  card,
                  scan_time,
                  access_allowed,
-                 device):
+                 device,
+                 identity):
         self.name_id = name_id
         self.first_name = first_name
         self.last_name = last_name
@@ -19,18 +27,29 @@ class CardScan(object):
         self.scan_time = scan_time
         self.access_allowed = access_allowed
         self.device = device
+        self.identity = identity  # Tells apart scans with the same scan_time
 
 
 class WinDSXCardScan(object):
+    _fetch_size = 500
+
     def __init__(self,
                  acs_db: Database,
-                 log_db: Database
+                 log_db: Database,
+                 reference_data: ReferenceDataCache,
+                 snapshot=None
                  ):
         self._acs_db: Database = acs_db
         self._log_db: Database = log_db
-        self._company = self._get_company_from_name("denhac")
-
-    def get_scan_events_since(self, timestamp):
+        self._reference_data = reference_data
+        # Names and devices are read from the snapshot when there is one. EvnLog is always read live, it's the tail we
+        # are following.
+        self._snapshot = acs_db if snapshot is None else snapshot
+        self._name_info = NameInfoCache(self._snapshot, fallback_db=None if snapshot is None else acs_db)
+        self._company_name = "denhac"
+
+    # Yields scans in batches of up to _fetch_size, oldest first, so a long catch-up never has all of EvnLog in memory.
+    def get_scan_events_since(self, timestamp) -> Iterator[List[CardScan]]:
         access_allowed_code = 8
         access_denied_unknown_code = 174
         sql = \
@@ -44,32 +63,44 @@ class WinDSXCardScan(object):
             FROM EvnLog
             WHERE Event IN ({access_allowed_code}, {access_denied_unknown_code})
             AND IO = ?
-            AND TimeDate > ?
+            AND TimeDate >= ?
+            ORDER BY TimeDate
         """
 
-        with self._log_db.lock:
-            rows = list(self._log_db.cursor.execute(sql, (self._company, timestamp)))
-
-        card_scans = []
-
-        for row in rows:
-            name_info = self._get_name_info_from_id(row.NameId)
-            if name_info is None:
-                continue  # We couldn't find the name for this event
-
-            access_allowed = row.Event == access_allowed_code
-            card_scans.append(CardScan(
-                name_id=row.NameId,
-                first_name=name_info.FirstName,
-                last_name=name_info.LastName,
-                company=name_info.CompanyName,
-                card=str(row.CardCode).strip('0').rstrip('.'),
-                scan_time=row.TimeDate,
-                access_allowed=access_allowed,
-                device=row.Device
-            ))
-
-        return card_scans
+        company = self._reference_data.company_id(self._company_name)
+        if company is None:
+            raise ValueError(f"No company found for company name '{self._company_name}'")
+
+        with self._log_db.read() as cursor:
+            cursor.execute(sql, (company, timestamp))
+
+            while True:
+                rows = cursor.fetchmany(self._fetch_size)
+                if len(rows) == 0:
+                    break
+
+                name_infos = self._name_info.get_many(row.NameId for row in rows)
+                card_scans = []
+
+                for row in rows:
+                    name_info = name_infos.get(row.NameId)
+                    if name_info is None:
+                        continue  # We couldn't find the name for this event
+
+                    access_allowed = row.Event == access_allowed_code
+                    card_scans.append(CardScan(
+                        name_id=row.NameId,
+                        first_name=name_info.FirstName,
+                        last_name=name_info.LastName,
+                        company=name_info.CompanyName,
+                        card=str(row.CardCode).strip('0').rstrip('.'),
+                        scan_time=row.TimeDate,
+                        access_allowed=access_allowed,
+                        device=row.Device,
+                        identity=(row.Device, row.Event, str(row.CardCode), row.NameId)
+                    ))
+
+                yield card_scans
 
     def get_devices(self):
         sql = \
@@ -80,39 +111,11 @@ class WinDSXCardScan(object):
                 FROM `DEV` D
             """
 
-        with self._acs_db.lock:
-            rows = list(self._acs_db.cursor.execute(sql))
+        with self._snapshot.read() as cursor:
+            rows = list(cursor.execute(sql))
 
         result = {}
         for row in rows:
             result[row.Device] = row.Name
 
         return result
-
-    def _get_name_info_from_id(self, name_id):
-        sql = \
-            """
-                SELECT
-                    N.ID AS NameId,
-                    N.FName AS FirstName,
-                    N.LName AS LastName,
-                    CO.Name AS CompanyName
-                FROM `NAMES` N
-                INNER JOIN `COMPANY` CO
-                    ON CO.Company = N.Company
-                WHERE N.ID = ?
-            """
-
-        with self._acs_db.lock:
-            name_rows = list(self._acs_db.cursor.execute(sql, name_id))
-
-        if len(name_rows) == 0:
-            return None
-
-        return name_rows[0]
-
-    def _get_company_from_name(self, company_name):
-        sql = "SELECT Company FROM COMPANY WHERE Name = ?"
-
-        with self._acs_db.lock:
-            return list(self._acs_db.cursor.execute(sql, company_name))[0].Company
@@ -1,25 +1,115 @@
-from threading import Lock
+import threading
+from contextlib import contextmanager
+from threading import Lock, RLock
+from typing import Any, Iterator, List, Optional
 
-import pyodbc
+from card_auto_add.windsx.query_stats import InstrumentedCursor, QueryStats
 
 
+# Connections to one WinDSX database. Reads and writes take separate paths so a long running write never holds up
+# something like the scan watcher:
+#
+# - read() hands out a cursor on a read only, autocommit connection that belongs to the calling thread. Reads don't lock
+#   anything on our side, so any number of threads can read at once.
+# - transaction() serializes writers on the single writer connection. It commits when the outermost transaction exits
+#   cleanly and rolls back if it raises. Nested transactions join the one that's already open.
+#
+# Reads that need to see the transaction's own uncommitted changes have to go through cursor inside the transaction.
+#
+# Connections come from a backend, anything with a connect(read_only) method returning a pyodbc style connection.
+# AccessBackend is the real WinDSX database, SqliteBackend a stand-in for running and measuring things elsewhere.
+#
+# Every cursor handed out is instrumented, see stats for how long each statement has been taking.
+#
+# A read_only Database never opens the writer connection, and only read() can be used on it.
 class Database(object):
-    def __init__(self, db_path):
-        self._connection = pyodbc.connect((
-                r'DRIVER={Microsoft Access Driver (*.mdb)};'
-                r'DBQ=' + str(db_path) + ";"
-        ))
-        self._cursor = self.connection.cursor()
-        self._db_lock = Lock()
+    def __init__(self, backend, stats: Optional[QueryStats] = None, read_only: bool = False):
+        self._backend = backend
+        self._stats = QueryStats("database") if stats is None else stats
+        self._read_only = read_only
+
+        self._writer_connection = None
+        self._writer_cursor = None
+        if not read_only:
+            self._writer_connection = backend.connect(read_only=False)
+            self._writer_cursor = InstrumentedCursor(self._writer_connection.cursor(), self._stats)
+        self._writer_lock = RLock()
+        self._writer_owner: Optional[int] = None
+        self._transaction_depth = 0
+
+        self._local = threading.local()
+        self._read_connections: List[Any] = []
+        self._read_connections_lock = Lock()
 
     @property
-    def lock(self) -> Lock:
-        return self._db_lock
+    def stats(self) -> QueryStats:
+        return self._stats
 
     @property
-    def connection(self) -> pyodbc.Connection:
-        return self._connection
+    def in_transaction(self) -> bool:
+        return self._writer_owner == threading.get_ident()
 
+    # The writer cursor. Only usable from inside transaction() on the same thread.
     @property
-    def cursor(self) -> pyodbc.Cursor:
-        return self._cursor
+    def cursor(self):
+        if not self.in_transaction:
+            raise RuntimeError("The writer cursor can only be used inside a transaction")
+
+        return self._writer_cursor
+
+    @contextmanager
+    def read(self) -> Iterator[Any]:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._backend.connect(read_only=True)
+            self._local.connection = connection
+            with self._read_connections_lock:
+                self._read_connections.append(connection)
+
+        cursor = InstrumentedCursor(connection.cursor(), self._stats)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[Any]:
+        if self._read_only:
+            raise RuntimeError("Can't write to a read only database")
+
+        with self._writer_lock:
+            self._writer_owner = threading.get_ident()
+            self._transaction_depth += 1
+            try:
+                yield self._writer_cursor
+
+                if self._transaction_depth == 1:
+                    self._writer_cursor.flush()
+                    self._writer_connection.commit()
+            except BaseException:
+                if self._transaction_depth == 1:
+                    self._writer_cursor.flush()
+                    self._writer_connection.rollback()
+                raise
+            finally:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._writer_owner = None
+
+    # Throws away everything the current transaction has done so far, without ending it. Access doesn't have savepoints,
+    # so this is the only way to undo part of a batch.
+    def rollback(self):
+        if not self.in_transaction:
+            raise RuntimeError("Can only roll back inside a transaction")
+
+        self._writer_connection.rollback()
+
+    def close(self):
+        with self._read_connections_lock:
+            for connection in self._read_connections:
+                connection.close()
+            self._read_connections.clear()
+
+        with self._writer_lock:
+            if self._writer_connection is not None:
+                self._writer_connection.close()
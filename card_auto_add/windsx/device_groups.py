@@ -0,0 +1,104 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+from card_auto_add.windsx.database import Database
+
+
+# In memory view of DGRP. Each device group is stored as a 128 bit mask (bit N set means device N is in the group), so
+# finding a group that matches a set of devices is a single dictionary lookup. Like AclComboIndex, a cheap row count/max
+# signature is checked by refresh_if_changed to notice changes made outside of this process.
+#
+# Doors being added to or removed from an existing group don't change that signature, so a group's row is read again
+# before find hands it out, and everything is reloaded if it no longer has the devices we think it does.
+class DeviceGroupIndex(object):
+    DEVICE_COUNT = 128
+
+    def __init__(self, acs_db: Database):
+        self._acs_db = acs_db
+        self._group_by_mask: Dict[int, float] = {}
+        self._next_group: int = 1
+        self._signature: Optional[Tuple] = None
+
+    @classmethod
+    def mask_for(cls, devices: Iterable[int]) -> int:
+        mask = 0
+        for device in devices:
+            if not 0 <= device < cls.DEVICE_COUNT:
+                raise ValueError(f"Device {device} is outside of the {cls.DEVICE_COUNT} devices a group can hold")
+            mask |= 1 << device
+        return mask
+
+    def refresh_if_changed(self):
+        signature = self._read_signature()
+
+        if signature != self._signature:
+            self._load()
+            self._signature = signature
+
+    def invalidate(self):
+        self._signature = None
+
+    def find(self, mask: int):
+        device_group = self._group_by_mask.get(mask)
+
+        if device_group is not None and self._read_mask(device_group) != mask:
+            self._load()
+            self._signature = self._read_signature()
+            device_group = self._group_by_mask.get(mask)
+
+        return device_group
+
+    def create(self, mask: int):
+        device_group = self._next_group
+
+        columns = ["DGrp", "DlFlag", "CkSum"] + [f"D{i}" for i in range(self.DEVICE_COUNT)]
+        sql = f"INSERT INTO DGRP({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+        values = [device_group, 1, 0]
+        for i in range(self.DEVICE_COUNT):
+            values.append(bool(mask >> i & 1))
+
+        self._acs_db.cursor.execute(sql, values)
+
+        self._group_by_mask[mask] = device_group
+        self._next_group = device_group + 1
+        # Our own insert changes the signature, and we don't want it to force a reload
+        self._signature = self._read_signature()
+
+        return device_group
+
+    def _read_mask(self, device_group) -> Optional[int]:
+        row = self._acs_db.cursor.execute(f"SELECT {self._device_columns()} FROM DGRP WHERE DGrp = ?",
+                                          device_group).fetchone()
+        return None if row is None else self._mask_of(row)
+
+    def _read_signature(self):
+        return tuple(self._acs_db.cursor.execute("SELECT COUNT(*), MAX(DGrp) FROM DGRP").fetchone())
+
+    def _load(self):
+        group_by_mask = {}
+        max_group = 0
+        for row in self._acs_db.cursor.execute(f"SELECT DGrp, {self._device_columns()} FROM DGRP ORDER BY DGrp"):
+            device_group = row[0]
+            mask = self._mask_of(row, 1)
+
+            # Keep the first (lowest) group if two of them have the same devices
+            group_by_mask.setdefault(mask, device_group)
+
+            if float(device_group).is_integer():
+                max_group = max(max_group, int(device_group))
+
+        self._group_by_mask = group_by_mask
+        self._next_group = max_group + 1
+
+    @classmethod
+    def _device_columns(cls) -> str:
+        return ", ".join(f"D{i}" for i in range(cls.DEVICE_COUNT))
+
+    # D0..D127 start at column offset of the row
+    @classmethod
+    def _mask_of(cls, row, offset: int = 0) -> int:
+        mask = 0
+        for i in range(cls.DEVICE_COUNT):
+            if row[i + offset]:
+                mask |= 1 << i
+        return mask
@@ -1,6 +1,10 @@
+import select
 import socket
 import time
+from collections import deque
 from enum import Enum
+from threading import Lock
+from typing import Iterable, Optional, Tuple
 
 
 class DoorState(Enum):
@@ -9,35 +13,148 @@ class DoorState(Enum):
     TIME_ZONE = 3
 
 
+# Client for the Comm Server's command port. One connection is kept open and reused, every command in a batch is sent
+# in one go and then we wait for one "\r\n" acknowledgement per command, in order. If the connection drops or times out
+# we reconnect and resend whatever wasn't acknowledged yet, door states are idempotent so a repeat is harmless. A Comm
+# Server that closes the connection after each command still works, just with a reconnect per command.
+#
+# We've only ever seen the Comm Server answer after we shut down our side of the connection. If the first pipelined
+# batch gets no acknowledgement within probe_timeout, we fall back to that for good: one connection per command, shut
+# down after sending, with the same pause after each that we've always had.
 class DoorOverride(object):
-    _host = "127.0.0.1"
-    _port = 22223
-
-    @classmethod
-    def set_state(cls, door_num: int, door_state: DoorState):
-        # Sometimes the first one doesn't trigger, and we don't know why so do it twice?
-        cls._set_state_internal(door_num, door_state)
-        cls._set_state_internal(door_num, door_state)
-
-    @classmethod
-    def _set_state_internal(cls, door_num, door_state):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(10)
-            s.connect((cls._host, cls._port))
-            s.sendall(f"6 80 3 {door_num} 0 {door_state.value} 3830202337 11 *Comm Server\r\n".encode('ascii'))
-            s.sendall(b"\r\n")
+    _attempts = 3  # In a row without an acknowledgement
+    _one_shot_pause_seconds = 0.5
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 22223,
+                 timeout: float = 10,
+                 probe_timeout: float = 2):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._probe_timeout = probe_timeout
+        self._lock = Lock()
+        self._socket: Optional[socket.socket] = None
+        self._buffer = b""
+        self._pipelined = True
+        self._pipelining_confirmed = False
+
+    def set_states(self, door_states: Iterable[Tuple[int, DoorState]]):
+        commands = [
+            f"6 80 3 {door_num} 0 {door_state.value} 3830202337 11 *Comm Server\r\n\r\n".encode('ascii')
+            for door_num, door_state in door_states
+        ]
+
+        if len(commands) == 0:
+            return
+
+        with self._lock:
+            # Sometimes the first one doesn't trigger, and we don't know why so do it twice? The repeats only go out
+            # once the Comm Server has acknowledged the first round.
+            for _ in range(2):
+                self._send(deque(commands))
+
+    def set_state(self, door_num: int, door_state: DoorState):
+        self.set_states([(door_num, door_state)])
+
+    def open(self, door_num: int):
+        self.set_state(door_num, DoorState.OPEN)
+
+    def secure(self, door_num: int):
+        self.set_state(door_num, DoorState.SECURE)
+
+    def time_zone(self, door_num: int):
+        self.set_state(door_num, DoorState.TIME_ZONE)
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _send(self, commands: deque):
+        if self._pipelined:
+            try:
+                self._send_pipelined(commands)
+                return
+            except socket.timeout:
+                if self._pipelining_confirmed:
+                    raise
+                self._disconnect()
+                self._pipelined = False
+
+        while len(commands) > 0:
+            self._send_one_shot(commands[0])
+            commands.popleft()
+
+    def _send_pipelined(self, commands: deque):
+        failures = 0
+        while len(commands) > 0:
+            try:
+                if self._socket is not None:
+                    self._discard_stale_input()
+                if self._socket is None:
+                    self._connect()
+
+                self._socket.sendall(b"".join(commands))
+                while len(commands) > 0:
+                    self._read_ack()
+                    commands.popleft()
+                    failures = 0
+            except socket.timeout:
+                self._disconnect()
+                if not self._pipelining_confirmed:
+                    raise  # Probably a Comm Server that waits for us to shut down our side, see _send
+                failures += 1
+                if failures >= self._attempts:
+                    raise
+            except OSError:
+                self._disconnect()
+                failures += 1
+                if failures >= self._attempts:
+                    raise
+
+    def _send_one_shot(self, command: bytes):
+        with socket.create_connection((self._host, self._port), timeout=self._timeout) as s:
+            s.sendall(command)
             s.shutdown(socket.SHUT_WR)
             s.recv(1024)  # Should just return \r\n, but we don't check for it.
-        time.sleep(0.5)
+        time.sleep(self._one_shot_pause_seconds)
+
+    def _connect(self):
+        self._socket = socket.create_connection((self._host, self._port), timeout=self._timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self._pipelining_confirmed:
+            self._socket.settimeout(min(self._timeout, self._probe_timeout))
+        self._buffer = b""
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._buffer = b""
+
+    # Leftover acknowledgements from an earlier batch would be matched to the wrong commands, and an idle connection the
+    # Comm Server has since closed is better found out about before we send anything on it.
+    def _discard_stale_input(self):
+        self._buffer = b""
+        while len(select.select([self._socket], [], [], 0)[0]) > 0:
+            if len(self._socket.recv(1024)) == 0:
+                self._disconnect()
+                return
 
-    @classmethod
-    def open(cls, door_num: int):
-        cls.set_state(door_num, DoorState.OPEN)
+    def _read_ack(self):
+        while b"\r\n" not in self._buffer:
+            data = self._socket.recv(1024)
+            if len(data) == 0:
+                raise ConnectionResetError("Comm Server closed the connection")
+            self._buffer += data
 
-    @classmethod
-    def secure(cls, door_num: int):
-        cls.set_state(door_num, DoorState.SECURE)
+        # Should just be \r\n, but we don't check for it
+        _, self._buffer = self._buffer.split(b"\r\n", 1)
 
-    @classmethod
-    def time_zone(cls, door_num: int):
-        cls.set_state(door_num, DoorState.TIME_ZONE)
+        if not self._pipelining_confirmed:
+            self._pipelining_confirmed = True
+            self._socket.settimeout(self._timeout)
@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple
+
+from card_auto_add.windsx.database import Database
+
+
+# Bounded LRU cache of NAMES/COMPANY info by name ID, so a burst of scans from the same few members doesn't cost a query
+# per scan. Misses are looked up together with IN queries. Entries also expire after ttl_seconds so renames in WinDSX
+# eventually show up. Names that aren't found aren't cached.
+#
+# acs_db can be a snapshot that lags behind the live database, in which case IDs it doesn't know yet (members activated
+# since the snapshot was taken) are looked up again in fallback_db.
+class NameInfoCache(object):
+    _max_ids_per_query = 100
+
+    def __init__(self,
+                 acs_db,
+                 max_size: int = 1000,
+                 ttl_seconds: float = 60 * 60,
+                 fallback_db: Optional[Database] = None):
+        self._acs_db = acs_db
+        self._fallback_db = fallback_db
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._entries: "OrderedDict[int, Tuple[float, object]]" = OrderedDict()
+
+    # Returns a dict of name ID to row (NameId, FirstName, LastName, CompanyName) for every ID that exists
+    def get_many(self, name_ids: Iterable[int]) -> Dict[int, object]:
+        now = time.monotonic()
+        found = {}
+        missing = []
+
+        with self._lock:
+            for name_id in set(name_ids):
+                entry = self._entries.get(name_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(name_id)
+                    found[name_id] = entry[1]
+                else:
+                    missing.append(name_id)
+
+        if len(missing) == 0:
+            return found
+
+        rows = self._query(self._acs_db, missing)
+        if self._fallback_db is not None and len(rows) < len(missing):
+            found_ids = set(row.NameId for row in rows)
+            rows.extend(self._query(self._fallback_db, [name_id for name_id in missing if name_id not in found_ids]))
+
+        with self._lock:
+            for row in rows:
+                found[row.NameId] = row
+                self._entries[row.NameId] = (now + self._ttl_seconds, row)
+                self._entries.move_to_end(row.NameId)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+        return found
+
+    def _query(self, database, name_ids):
+        rows = []
+
+        with database.read() as cursor:
+            for i in range(0, len(name_ids), self._max_ids_per_query):
+                chunk = name_ids[i:i + self._max_ids_per_query]
+                placeholders = ", ".join("?" * len(chunk))
+                sql = \
+                    f"""
+                        SELECT
+                            N.ID AS NameId,
+                            N.FName AS FirstName,
+                            N.LName AS LastName,
+                            CO.Name AS CompanyName
+                        FROM `NAMES` N
+                        INNER JOIN `COMPANY` CO
+                            ON CO.Company = N.Company
+                        WHERE N.ID IN ({placeholders})
+                    """
+                rows.extend(cursor.execute(sql, chunk))
+
+        return rows
@@ -0,0 +1,188 @@
+import bisect
+import re
+import time
+from functools import lru_cache
+from logging import Logger
+from threading import Lock
+from typing import Dict, List, Optional
+
+_whitespace = re.compile(r"\s+")
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+_in_list = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+
+
+# Collapses a statement down to its shape, so that queries only differing by literals or the length of an IN list are
+# counted together
+@lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    sql = _whitespace.sub(" ", sql).strip()
+    sql = _string_literal.sub("?", sql)
+    sql = _number_literal.sub("?", sql)
+    return _in_list.sub("IN (...)", sql)
+
+
+class StatementStats(object):
+    # Upper bounds of the latency histogram buckets, in seconds. Anything slower lands in one last overflow bucket.
+    BUCKETS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram: List[int] = [0] * (len(self.BUCKETS) + 1)
+
+    def record(self, seconds: float, rows: int):
+        self.count += 1
+        self.rows += rows
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    # Upper bound of the bucket the given percentile falls in, but never more than the slowest time we've seen
+    def percentile(self, fraction: float) -> float:
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.histogram):
+            seen += bucket_count
+            if seen >= target and bucket_count > 0:
+                if index == len(self.BUCKETS):
+                    return self.max_seconds
+                return min(self.BUCKETS[index], self.max_seconds)
+        return self.max_seconds
+
+
+# Latency and row counts for every statement run on a Database, keyed by normalized SQL. Statements slower than
+# slow_query_seconds are logged as they happen, and dump() gives a table of everything seen so far.
+class QueryStats(object):
+    def __init__(self, name: str, logger: Optional[Logger] = None, slow_query_seconds: Optional[float] = None):
+        self._name = name
+        self._logger = logger
+        self._slow_query_seconds = slow_query_seconds
+        self._lock = Lock()
+        self._statements: Dict[str, StatementStats] = {}
+
+    def record(self, sql: str, seconds: float, rows: int):
+        key = normalize_sql(sql)
+
+        with self._lock:
+            statement = self._statements.get(key)
+            if statement is None:
+                statement = self._statements[key] = StatementStats()
+            statement.record(seconds, rows)
+
+        if self._logger is not None and self._slow_query_seconds is not None and seconds >= self._slow_query_seconds:
+            self._logger.warning(f"Slow query on {self._name} took {seconds * 1000:.0f} ms for {rows} row(s): {key}")
+
+    def snapshot(self) -> Dict[str, StatementStats]:
+        with self._lock:
+            return dict(self._statements)
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+
+    # Slowest statements in total first
+    def dump(self, limit: int = 25) -> str:
+        statements = sorted(self.snapshot().items(), key=lambda item: item[1].total_seconds, reverse=True)
+
+        lines = [
+            f"Query stats for {self._name}, {len(statements)} distinct statement(s)",
+            f"{'total ms':>10} {'count':>7} {'mean ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>9} {'rows':>8}  sql",
+        ]
+        for sql, statement in statements[:limit]:
+            lines.append(
+                f"{statement.total_seconds * 1000:>10.1f} {statement.count:>7} "
+                f"{statement.total_seconds / statement.count * 1000:>9.2f} "
+                f"{statement.percentile(0.5) * 1000:>8.1f} {statement.percentile(0.95) * 1000:>8.1f} "
+                f"{statement.max_seconds * 1000:>9.1f} {statement.rows:>8}  {sql[:200]}"
+            )
+
+        return "\n".join(lines)
+
+
+# Wraps a pyodbc style cursor and reports each statement to QueryStats. A statement's time includes fetching its rows,
+# so it's recorded once the next statement starts or the cursor is closed.
+class InstrumentedCursor(object):
+    def __init__(self, cursor, stats: QueryStats):
+        self._cursor = cursor
+        self._stats = stats
+        self._sql: Optional[str] = None
+        self._seconds = 0.0
+        self._rows = 0
+        self._fetched = False
+
+    def execute(self, sql: str, *params) -> "InstrumentedCursor":
+        self.flush()
+
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(sql, *params)
+        finally:
+            self._sql = sql
+            self._seconds = time.perf_counter() - start
+            self._rows = 0
+            self._fetched = False
+
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched_rows(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size: int):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size)
+        self._fetched_rows(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched_rows(start, len(rows))
+        return rows
+
+    def fetchval(self):
+        start = time.perf_counter()
+        value = self._cursor.fetchval()
+        self._fetched_rows(start, 0 if value is None else 1)
+        return value
+
+    def __iter__(self):
+        iterator = iter(self._cursor)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                self._fetched_rows(start, 0)
+                return
+            self._fetched_rows(start, 1)
+            yield row
+
+    def close(self):
+        self.flush()
+        self._cursor.close()
+
+    # Records the current statement now instead of waiting for the next one
+    def flush(self):
+        if self._sql is None:
+            return
+
+        rows = self._rows
+        if not self._fetched:
+            rows = max(getattr(self._cursor, "rowcount", 0), 0)  # Rows touched by an INSERT/UPDATE/DELETE
+
+        self._stats.record(self._sql, self._seconds, rows)
+        self._sql = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _fetched_rows(self, start: float, rows: int):
+        self._seconds += time.perf_counter() - start
+        self._rows += rows
+        self._fetched = True
@@ -0,0 +1,50 @@
+import time
+from threading import Lock
+from typing import Dict, Tuple
+
+from card_auto_add.windsx.database import Database
+
+
+# Caches lookups of rows that almost never change (UDF names, ACL group names, companies) so that each activation or
+# scan poll doesn't have to go back to the Access driver for them. Entries expire after ttl_seconds, and invalidate can
+# be used to drop them early. Lookups that find nothing aren't cached, and drop everything else that is, since someone
+# has been changing these tables in WinDSX.
+class ReferenceDataCache(object):
+    def __init__(self, acs_db: Database, ttl_seconds: float = 60 * 60):
+        self._acs_db = acs_db
+        self._ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._entries: Dict[Tuple[str, str], Tuple[float, object]] = {}
+
+    def udf_num(self, udf_name):
+        return self._lookup("SELECT UdfNum FROM UdfName WHERE Name = ?", udf_name)
+
+    def company_id(self, company_name):
+        return self._lookup("SELECT Company FROM COMPANY WHERE Name = ?", company_name)
+
+    def acl_name_id(self, acl_name):
+        return self._lookup("SELECT ID FROM AclGrpName WHERE Name = ?", acl_name)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, sql, name):
+        key = (sql, name)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        with self._acs_db.read() as cursor:
+            value = cursor.execute(sql, name).fetchval()
+
+        if value is None:
+            self.invalidate()
+        else:
+            with self._lock:
+                self._entries[key] = (now + self._ttl_seconds, value)
+
+        return value
@@ -0,0 +1,170 @@
+import glob
+import os
+import shutil
+from contextlib import contextmanager
+from logging import Logger
+from threading import Lock
+from typing import Any, Callable, Iterator, Optional
+
+from card_auto_add.file_change_monitor import FileChangeMonitor
+from card_auto_add.runtime import Runtime
+from card_auto_add.windsx.database import Database
+from card_auto_add.windsx.query_stats import QueryStats
+
+
+class _Snapshot(object):
+    def __init__(self, path: str, database: Database):
+        self.path = path
+        self.database = database
+        self.leases = 0
+        self.retired = False
+
+
+# Serves heavy read only queries (reports, scan enrichment) from a local copy of an Access database, so they never fight
+# WinDSX and the Comm Server for page locks on the live file. The copy is refreshed from its own runtime task when the
+# source file has changed, every min_refresh_seconds at most, so results can be that far behind the live database.
+# Readers never wait on a copy being taken, except for the very first one if it's needed before the task has run.
+#
+# Readers hold on to the copy they started with until they're done, old copies are closed and deleted after that.
+class SnapshotReader(object):
+    _copy_attempts = 3
+
+    def __init__(self,
+                 source_path,
+                 scratch_dir,
+                 backend_factory: Callable[[str], Any],
+                 stats: Optional[QueryStats] = None,
+                 min_refresh_seconds: float = 60,
+                 logger: Optional[Logger] = None):
+        self._source_path = str(source_path)
+        self._scratch_dir = str(scratch_dir)
+        self._backend_factory = backend_factory
+        self._stats = QueryStats("snapshot") if stats is None else stats
+        self._min_refresh_seconds = min_refresh_seconds
+        self._logger = logger
+
+        self._lock = Lock()
+        self._refresh_lock = Lock()
+        self._monitor = FileChangeMonitor(self._source_path)
+        self._current: Optional[_Snapshot] = None
+        self._stale = False  # Set when a change was seen but copying it failed
+        self._generation = 0
+
+        os.makedirs(self._scratch_dir, exist_ok=True)
+        self._remove_leftover_copies()
+
+    def start(self, runtime: Runtime):
+        runtime.every("acs_snapshot", self.refresh, self._min_refresh_seconds)
+
+    @property
+    def stats(self) -> QueryStats:
+        return self._stats
+
+    @contextmanager
+    def read(self) -> Iterator[Any]:
+        snapshot = self._acquire()
+        try:
+            with snapshot.database.read() as cursor:
+                yield cursor
+        finally:
+            self._release(snapshot)
+
+    # Takes a new copy if the source changed since the last one
+    def refresh(self):
+        with self._refresh_lock:
+            with self._lock:
+                current = self._current
+
+            if current is not None and not self._stale and not self._monitor.changed():
+                return
+
+            try:
+                snapshot = self._take_snapshot()
+            except Exception:
+                if current is None:
+                    raise
+                # Stick with the copy we have, we'll try again next time around
+                self._stale = True
+                if self._logger is not None:
+                    self._logger.exception(f"Could not refresh the snapshot of {self._source_path}", exc_info=True)
+                return
+
+            self._stale = False
+            with self._lock:
+                self._current = snapshot
+                if current is not None:
+                    self._retire(current)
+
+    def close(self):
+        with self._lock:
+            if self._current is not None:
+                self._retire(self._current)
+                self._current = None
+
+    def _acquire(self) -> _Snapshot:
+        with self._lock:
+            if self._current is not None:
+                self._current.leases += 1
+                return self._current
+
+        # Only before the refresh task has taken the first copy
+        self.refresh()
+
+        with self._lock:
+            if self._current is None:
+                raise RuntimeError(f"No snapshot of {self._source_path} could be taken")
+            self._current.leases += 1
+            return self._current
+
+    def _release(self, snapshot: _Snapshot):
+        with self._lock:
+            snapshot.leases -= 1
+            if snapshot.retired and snapshot.leases == 0:
+                self._dispose(snapshot)
+
+    def _take_snapshot(self) -> _Snapshot:
+        self._generation += 1
+        name, extension = os.path.splitext(os.path.basename(self._source_path))
+        path = os.path.join(self._scratch_dir, f"{name}.snapshot-{self._generation}{extension}")
+        partial_path = path + ".partial"
+
+        # Anything written from here on shows up as a change, at worst that's one extra copy
+        self._monitor.changed()
+
+        # The source can be written to while we copy it. If it changed underneath us the copy may be torn, so try again.
+        for _ in range(self._copy_attempts):
+            before = self._signature()
+            shutil.copyfile(self._source_path, partial_path)
+            if self._signature() == before:
+                break
+        else:
+            os.remove(partial_path)
+            raise RuntimeError(f"{self._source_path} kept changing while we copied it")
+
+        os.replace(partial_path, path)
+
+        return _Snapshot(path, Database(self._backend_factory(path), self._stats, read_only=True))
+
+    def _signature(self):
+        stat = os.stat(self._source_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _retire(self, snapshot: _Snapshot):
+        snapshot.retired = True
+        if snapshot.leases == 0:
+            self._dispose(snapshot)
+
+    def _dispose(self, snapshot: _Snapshot):
+        try:
+            snapshot.database.close()
+            os.remove(snapshot.path)
+        except OSError:
+            pass  # Cleaned up on the next start
+
+    def _remove_leftover_copies(self):
+        name, extension = os.path.splitext(os.path.basename(self._source_path))
+        for path in glob.glob(os.path.join(self._scratch_dir, f"{glob.escape(name)}.snapshot-*")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
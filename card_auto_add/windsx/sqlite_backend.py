@@ -0,0 +1,197 @@
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Stand-in for the WinDSX Access databases, backed by SQLite, so that our queries can be run, tested and measured on a
+# machine without WinDSX or the Access driver. Only the tables and columns this project touches are modeled, and
+# connections only mimic the parts of pyodbc we use: execute returning the cursor, fetchval, and rows whose columns can
+# be read as attributes.
+
+_device_columns = ", ".join(f"D{i} BOOLEAN NOT NULL DEFAULT 0" for i in range(128))
+
+SCHEMA = f"""
+    CREATE TABLE COMPANY (Company INTEGER PRIMARY KEY, Name TEXT NOT NULL);
+    CREATE TABLE NAMES (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        LocGrp INTEGER,
+        FName TEXT,
+        LName TEXT,
+        Company INTEGER
+    );
+    CREATE INDEX NAMES_FName_LName ON NAMES (FName, LName);
+    CREATE TABLE UdfName (UdfNum INTEGER PRIMARY KEY, Name TEXT NOT NULL);
+    CREATE TABLE UDF (LocGrp INTEGER, NameID INTEGER, UdfNum INTEGER, UdfText TEXT);
+    CREATE INDEX UDF_NameID ON UDF (NameID);
+    CREATE INDEX UDF_UdfNum_UdfText ON UDF (UdfNum, UdfText);
+    CREATE TABLE CARDS (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        NameID INTEGER,
+        LocGrp INTEGER,
+        Code REAL,
+        StartDate TIMESTAMP,
+        StopDate TIMESTAMP,
+        Status BOOLEAN,
+        CardNum TEXT,
+        DlFlag INTEGER,
+        AclGrpComboId INTEGER
+    );
+    CREATE INDEX CARDS_Code ON CARDS (Code);
+    CREATE INDEX CARDS_NameID ON CARDS (NameID);
+    CREATE TABLE LocCards (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Loc INTEGER,
+        CardID INTEGER,
+        DlFlag INTEGER,
+        CkSum INTEGER,
+        Acl INTEGER,
+        Acl1 INTEGER,
+        Acl2 INTEGER,
+        Acl3 INTEGER,
+        Acl4 INTEGER
+    );
+    CREATE INDEX LocCards_CardID ON LocCards (CardID);
+    CREATE TABLE AclGrpName (ID INTEGER PRIMARY KEY, Name TEXT NOT NULL);
+    CREATE TABLE AclGrpCombo (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        AclGrpNameID INTEGER,
+        ComboID INTEGER,
+        LocGrp INTEGER
+    );
+    -- ComboID is an AutoNumber in WinDSX, which still accepts explicit values
+    CREATE TRIGGER AclGrpCombo_ComboID AFTER INSERT ON AclGrpCombo WHEN NEW.ComboID IS NULL
+    BEGIN
+        UPDATE AclGrpCombo SET ComboID = NEW.ID WHERE ID = NEW.ID;
+    END;
+    CREATE TABLE ACLGrp (AclGrpNameID INTEGER, Dev INTEGER, Tz1 INTEGER, Tz2 INTEGER, Tz3 INTEGER, Tz4 INTEGER);
+    CREATE TABLE ACL (Loc INTEGER, Acl INTEGER, Tz INTEGER, DGrp INTEGER, DlFlag INTEGER, CkSum INTEGER);
+    CREATE TABLE DGRP (DGrp INTEGER, DlFlag INTEGER, CkSum INTEGER, {_device_columns});
+    CREATE TABLE DEV (Device INTEGER PRIMARY KEY, Name TEXT, DlFlag INTEGER, CkSum INTEGER);
+    CREATE TABLE IO (IO INTEGER PRIMARY KEY, DlFlag INTEGER);
+    CREATE TABLE LOC (
+        Loc INTEGER PRIMARY KEY,
+        PlFlag BOOLEAN,
+        DlFlag INTEGER,
+        FullDlFlag BOOLEAN,
+        NodeCs INTEGER,
+        CodeCs INTEGER,
+        AclCs INTEGER,
+        DGrpCs INTEGER
+    );
+    CREATE TABLE EvnLog (TimeDate TIMESTAMP, Event INTEGER, Code REAL, Opr INTEGER, Dev INTEGER, IO INTEGER);
+    CREATE INDEX EvnLog_TimeDate ON EvnLog (TimeDate);
+"""
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode("utf-8")))
+
+
+class SqliteRow(object):
+    __slots__ = ("_values", "_columns")
+
+    def __init__(self, values: tuple, columns: Dict[str, int]):
+        self._values = values
+        self._columns = columns
+
+    # Access column names aren't case sensitive, and neither are ours
+    def __getattr__(self, name):
+        try:
+            return self._values[self._columns[name.lower()]]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __repr__(self):
+        return repr(self._values)
+
+
+class SqliteCursor(object):
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+        self._columns: Dict[str, int] = {}
+
+    def execute(self, sql: str, *params) -> "SqliteCursor":
+        # pyodbc takes parameters as a sequence, as separate arguments, or as a single bare value
+        if len(params) == 1 and isinstance(params[0], (tuple, list)):
+            params = tuple(params[0])
+
+        self._cursor.execute(sql.replace("@@IDENTITY", "last_insert_rowid()"), params)
+
+        description = self._cursor.description or ()
+        self._columns = {column[0].lower(): index for index, column in enumerate(description)}
+
+        return self
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    def fetchone(self) -> Optional[SqliteRow]:
+        row = self._cursor.fetchone()
+        return None if row is None else SqliteRow(row, self._columns)
+
+    def fetchmany(self, size: int) -> List[SqliteRow]:
+        return [SqliteRow(row, self._columns) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self) -> List[SqliteRow]:
+        return [SqliteRow(row, self._columns) for row in self._cursor.fetchall()]
+
+    def fetchval(self):
+        row = self._cursor.fetchone()
+        return None if row is None else row[0]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield SqliteRow(row, self._columns)
+
+    def close(self):
+        self._cursor.close()
+
+
+class SqliteConnection(object):
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+
+    def cursor(self) -> SqliteCursor:
+        return SqliteCursor(self._connection.cursor())
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+class SqliteBackend(object):
+    def __init__(self, db_path):
+        self._db_path = str(db_path)
+
+    # Creates an empty database with the WinDSX schema
+    @classmethod
+    def create(cls, db_path) -> "SqliteBackend":
+        connection = sqlite3.connect(str(db_path))
+        connection.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer, like separate Jet connections
+        connection.executescript(SCHEMA)
+        connection.close()
+
+        return cls(db_path)
+
+    def connect(self, read_only: bool) -> SqliteConnection:
+        if read_only:
+            connection = sqlite3.connect(f"file:{self._db_path}?mode=ro", uri=True, isolation_level=None,
+                                         detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self._db_path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                         check_same_thread=False)
+
+        return SqliteConnection(connection)